@@ -1,50 +1,118 @@
 # backend/app.py
 # fixed potential problem per Gemini
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, request, jsonify, send_from_directory, render_template, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from config import Config
-from transcription import TranscriptionService
-from llm_processor import LLMProcessor
+from transcription import WEBHOOK_AUTH_HEADER, get_transcription_service
+from llm_processor import get_processor
 from docs_generator import GoogleDocsGenerator
 from pdf_generator import PDFGenerator
 from logger import logger
 from email_service import send_pdf_email
+import hmac
+import logging
 import os
 import tempfile
 import json
+import orjson
 import sqlite3
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from datetime import datetime
-from werkzeug.utils import secure_filename
+from urllib.parse import urlencode
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
 
-def validate_audio_file(file) -> tuple[bool, str]:
+# Plain form fields that accompany the 'audio' part of an upload
+AUDIO_FORM_FIELDS = (
+    'print_raw', 'create_doc', 'speakers_expected', 'speaker_labels', 'local_timestamp',
+    'consultation_timestamp', 'consent_given', 'consent_timestamp',
+)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB reads from the request socket
+
+
+class SpooledAudioTarget(BaseTarget):
+    """
+    streaming-form-data target backed by a SpooledTemporaryFile: typical
+    voice memos stay in RAM, only uploads above max_size spill to disk.
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+
+    def on_data_received(self, chunk: bytes):
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        self.file.close()
+
+
+def receive_audio_upload() -> tuple[SpooledAudioTarget | None, dict]:
     """
-    Validate an uploaded audio file before processing.
+    Stream a multipart upload into a spooled buffer with streaming-form-data,
+    bypassing Werkzeug's form parser (CPU-bound on large binary bodies).
+    Returns (audio target, form fields). Blank or missing fields are omitted,
+    so callers' .get() defaults apply. The target is None if the body is not
+    multipart/form-data; otherwise the caller must close() it.
+    """
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+    except ParseFailedException:
+        return None, {}
+
+    audio = SpooledAudioTarget(Config.AUDIO_SPOOL_MAX_BYTES)
+    values = {name: ValueTarget() for name in AUDIO_FORM_FIELDS}
+    parser.register('audio', audio)
+    for name, target in values.items():
+        parser.register(name, target)
+
+    try:
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            parser.data_received(chunk)
+    except Exception:
+        audio.close()
+        raise
+
+    audio.file.seek(0)
+    form = {name: t.value.decode('utf-8') for name, t in values.items() if t.value}
+    return audio, form
+
+
+def validate_audio_file(audio: SpooledAudioTarget | None) -> tuple[bool, str]:
+    """
+    Validate an uploaded audio file (already received into its spool) before processing.
     Returns (is_valid: bool, error_message: str).
     error_message is empty string when valid.
     """
-    if not file or file.filename == '':
+    if not audio or not audio.multipart_filename:
         return False, "No se recibió ningún archivo de audio."
 
-    _, ext = os.path.splitext(file.filename.lower())
+    filename = audio.multipart_filename
+    _, ext = os.path.splitext(filename.lower())
     if ext not in Config.ALLOWED_AUDIO_EXTENSIONS:
         return False, (
             f"Formato de archivo no permitido: '{ext}'. "
             "Formatos aceptados: WAV, MP3, WEBM, M4A."
         )
 
-    mime_type = (file.content_type or '').lower().split(';')[0].strip()
+    mime_type = (audio.multipart_content_type or '').lower().split(';')[0].strip()
     if mime_type and mime_type not in Config.ALLOWED_AUDIO_MIME_TYPES:
-        logger.warning(f"Validation: unexpected MIME type '{mime_type}' for file '{file.filename}'")
+        logger.warning(f"Validation: unexpected MIME type '{mime_type}' for file '{filename}'")
         # Log but don't reject — some browsers send non-standard MIME types for audio
 
     content_length = request.content_length
     if content_length and content_length > Config.MAX_AUDIO_SIZE_BYTES:
         return False, "El archivo es demasiado grande. Tamaño máximo permitido: 200 MB."
 
-    # Seek to end to get actual size, then reset
-    file.seek(0, 2)
-    actual_size = file.tell()
-    file.seek(0)
+    actual_size = audio.size
 
     if actual_size > Config.MAX_AUDIO_SIZE_BYTES:
         return False, "El archivo es demasiado grande. Tamaño máximo permitido: 200 MB."
@@ -55,34 +123,37 @@ def validate_audio_file(file) -> tuple[bool, str]:
     return True, ''
 
 
-# --- THE TELEPORTER ---
-# This checks if we are in the cloud. If so, it creates the secret file from a variable.
-# This recreates the physical JSON files from Render Environment Variables
-def teleport_secrets():
-    if os.environ.get("RENDER"):
-        logger.info("Teleporter: Running in Cloud mode...")
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson (native UTF-8, several times faster than
+    the stdlib on the nested structured_data payloads). Falls back to Flask's
+    default() for types orjson does not know.
+    """
+
+    def _options(self, indent: bool = False) -> int:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
 
-        # 1. Teleport the Client Secrets (OAuth Web)
-        if "GOOGLE_SECRETS_JSON" in os.environ:
-            with open("client_secrets.json", "w") as f:
-                f.write(os.environ["GOOGLE_SECRETS_JSON"])
-            logger.info("Teleporter: client_secrets.json created.")
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=self._options(bool(kwargs.get('indent')))).decode('utf-8')
 
-        # 2. Teleport the Service Account (if you use it)
-        if "GOOGLE_SERVICE_ACCOUNT_JSON" in os.environ:
-            with open("credentials.json", "w") as f:
-                f.write(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"])
-            logger.info("Teleporter: credentials.json created.")
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-# Run the teleporter immediately
-logger.info("Startup: Teleporter starting...")
-teleport_secrets()
-logger.info("Startup: Teleporter finished.")
-# ----------------------
+    def response(self, *args, **kwargs) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._options(indent) | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 
 # Initialize Flask app
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = Config.SECRET_KEY
 app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024  # 200MB — matches Config.MAX_AUDIO_SIZE_BYTES
 
@@ -120,11 +191,42 @@ except ValueError as e:
     logger.error("Flask: Please check your .env file")
     exit(1)
 
-# Initialize services
-transcription_service = TranscriptionService()
-llm_processor = LLMProcessor()
+# Initialize services — process-wide instances shared with any other importer
+transcription_service = get_transcription_service()
+llm_processor = get_processor()
 pdf_generator = PDFGenerator()
-# docs_generator = GoogleDocsGenerator() <-- Gemini says no good
+
+# Google Docs — built once on first use, not per request (token load, OAuth
+# refresh and two discovery builds are ~100-500 ms). Lazy so a missing token
+# can't stop the app from booting; a failed build is retried on the next call.
+_docs_generator = None
+_docs_generator_lock = threading.Lock()
+
+
+def get_docs_generator() -> GoogleDocsGenerator:
+    """Return the shared GoogleDocsGenerator, creating it on first use."""
+    global _docs_generator
+    if _docs_generator is None:
+        with _docs_generator_lock:
+            if _docs_generator is None:
+                _docs_generator = GoogleDocsGenerator()
+    return _docs_generator
+
+
+# Caps how many pipeline stages (AssemblyAI / Gemini / Docs) are in flight at
+# once. A threading semaphore rather than asyncio.Semaphore because Flask runs
+# each async view on its own event loop.
+_pipeline_slots = threading.BoundedSemaphore(Config.PIPELINE_MAX_CONCURRENCY)
+
+
+@asynccontextmanager
+async def pipeline_slot():
+    """Wait for a free pipeline slot without blocking the event loop."""
+    await asyncio.to_thread(_pipeline_slots.acquire)
+    try:
+        yield
+    finally:
+        _pipeline_slots.release()
 
 # ── SQLite session persistence ──────────────────────────────────────────────
 
@@ -181,8 +283,8 @@ def save_session(session_id: str, data: dict):
             (session_id, timestamp, transcript_text, transcript_confidence,
              transcript_duration, transcript_words, structured_data_json,
              doc_link, doc_title, consent_given, consent_timestamp,
-             full_response_json)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+             full_response_json, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             session_id,
             data.get('timestamp', datetime.now().isoformat()),
@@ -195,7 +297,8 @@ def save_session(session_id: str, data: dict):
             doc.get('title'),
             1 if data.get('consent_given') else 0,
             data.get('consent_timestamp'),
-            json.dumps(data, ensure_ascii=False)
+            json.dumps(data, ensure_ascii=False),
+            data.get('status', 'pending_review')
         ))
         conn.commit()
         conn.close()
@@ -259,6 +362,27 @@ def save_pdf_to_session(session_id: str, pdf_bytes: bytes):
         logger.warning(f"PDF: Could not store PDF: {str(e)}")
 
 
+def claim_session(session_id: str, from_status: str, to_status: str) -> bool:
+    """
+    Atomically move a session from from_status to to_status. True only for the
+    caller whose UPDATE changed the row — concurrent claims cannot both win.
+    """
+    try:
+        conn   = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE sessions SET status = ? WHERE session_id = ? AND status = ?',
+            (to_status, session_id, from_status)
+        )
+        conn.commit()
+        claimed = cursor.rowcount == 1
+        conn.close()
+        return claimed
+    except Exception as e:
+        logger.warning(f"DB: Could not claim session {session_id}: {str(e)}")
+        return False
+
+
 # Initialize on startup
 init_db()
 
@@ -269,74 +393,116 @@ init_db()
 def index():
     return render_template('index.html')
 
+@lru_cache(maxsize=1)
+def _health_body(second: int) -> bytes:
+    """Health payload, rebuilt at most once per second however often Render probes."""
+    timestamp = datetime.fromtimestamp(second).isoformat()
+    return (
+        '{"status":"healthy","service":"ClinIA Alpha","version":"0.1.0",'
+        f'"timestamp":"{timestamp}"}}'
+    ).encode('utf-8')
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'service': 'ClinIA Alpha',
-        'version': '0.1.0',
-        'timestamp': datetime.now().isoformat()
-    })
+    return Response(_health_body(int(time.time())), mimetype='application/json')
 
 @app.route('/api/process-audio', methods=['POST'])
-def process_audio():
+async def process_audio():
     """
     Main orchestrator endpoint - processes audio through entire pipeline
     
     Expected: multipart/form-data with 'audio' file
     Returns: Complete medical note with Google Docs link
     """
+    audio_file = None
     try:
-        # Step 1: Validate request
-        audio_file = request.files.get('audio')
+        # Step 1: Stream the upload into a spooled buffer, then validate it
+        audio_file, form = receive_audio_upload()
         is_valid, error_message = validate_audio_file(audio_file)
         if not is_valid:
             logger.warning(f"Validation: rejected upload — {error_message}")
             return jsonify({'error': error_message, 'error_code': 'INVALID_AUDIO_FILE'}), 400
-        logger.info(f"Validation: audio file accepted — {audio_file.filename}")
+        logger.info(f"Validation: audio file accepted — {audio_file.multipart_filename}")
         
         # Get optional parameters
-        print_raw = request.form.get('print_raw', 'true').lower() == 'true'
-        create_doc = request.form.get('create_doc', 'true').lower() == 'true'
-        speakers_expected = int(request.form.get('speakers_expected', 2))
-        local_timestamp = request.form.get('local_timestamp', datetime.now().strftime("%Y-%m-%d %H:%M"))
-        consultation_timestamp = request.form.get('consultation_timestamp', local_timestamp)
-        consent_given = request.form.get('consent_given', 'false').lower() == 'true'
-        consent_timestamp = request.form.get('consent_timestamp', '')
+        print_raw = form.get('print_raw', 'true').lower() == 'true'
+        create_doc = form.get('create_doc', 'true').lower() == 'true'
+        speakers_expected = int(form.get('speakers_expected', 2))
+        # Diarization roughly doubles transcription time — on by default only
+        # in the raw-transcript (alpha verification) mode
+        speaker_labels = form.get('speaker_labels', str(print_raw)).lower() == 'true'
+        local_timestamp = form.get('local_timestamp', datetime.now().strftime("%Y-%m-%d %H:%M"))
+        consultation_timestamp = form.get('consultation_timestamp', local_timestamp)
+        consent_given = form.get('consent_given', 'false').lower() == 'true'
+        consent_timestamp = form.get('consent_timestamp', '')
+        # Stored alongside the response so confirm_and_generate can read them
+        session_extras = {
+            'local_timestamp': local_timestamp,
+            'create_doc': create_doc,
+            'consent_given': consent_given,
+            'consent_timestamp': consent_timestamp
+        }
         
         logger.info("Orchestrator: Starting new processing job")
-        logger.info(f"Orchestrator: Filename: {audio_file.filename}")
-        logger.debug(f"Orchestrator: Print raw transcript: {print_raw}")
-        logger.debug(f"Orchestrator: Create Google Doc: {create_doc}")
-        
-        # Step 2: Save audio to temporary file
-        filename = secure_filename(audio_file.filename)
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, f"clinia_{datetime.now().timestamp()}_{filename}")
-        
-        audio_file.save(temp_path)
-        logger.debug(f"Orchestrator: Audio saved to: {temp_path}")
-
-        # Get file size for validation
-        file_size = os.path.getsize(temp_path)
-        logger.debug(f"Orchestrator: File size: {file_size / (1024*1024):.2f} MB")
+        logger.info(f"Orchestrator: Filename: {audio_file.multipart_filename}")
+        logger.debug("Orchestrator: Print raw transcript: %s", print_raw)
+        logger.debug("Orchestrator: Create Google Doc: %s", create_doc)
+        logger.debug("Orchestrator: Speaker labels: %s", speaker_labels)
+
+        # Step 2: Audio was received during parsing (in RAM unless it spilled to disk)
+        file_size = audio_file.size
+        logger.debug("Orchestrator: File size: %.2f MB", file_size / (1024*1024))
+
+        # Webhook mode: submit and return at once — AssemblyAI calls back when the
+        # transcript is ready (assemblyai_webhook runs Phase B); the client polls
+        # /api/session/<id> until status leaves 'transcribing'
+        if Config.ASSEMBLYAI_WEBHOOK_URL:
+            session_id = f"SESSION-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            webhook_url = f"{Config.ASSEMBLYAI_WEBHOOK_URL}?{urlencode({'session_id': session_id})}"
+            try:
+                async with pipeline_slot():
+                    transcript_id = await asyncio.to_thread(
+                        transcription_service.submit_audio,
+                        audio_file.file, webhook_url, speakers_expected, speaker_labels
+                    )
+            except Exception as e:
+                logger.error(f"Orchestrator: Transcription submit failed: {str(e)}")
+                return jsonify({
+                    'error': 'Transcription failed',
+                    'details': str(e)
+                }), 500
+
+            save_session(session_id, {
+                'session_id': session_id,
+                'status': 'transcribing',
+                'transcript_id': transcript_id,
+                'print_raw': print_raw,
+                'consultation_timestamp': consultation_timestamp,
+                **session_extras
+            })
+            logger.info(f"Orchestrator: Awaiting AssemblyAI webhook. Session: {session_id}")
+            return jsonify({'session_id': session_id, 'status': 'transcribing'}), 202
 
         # Step 3: Transcribe audio (Phase A)
         logger.info("Orchestrator: PHASE A — Transcription")
         
         try:
-            transcript_result = transcription_service.transcribe_audio(
-                temp_path,
-                print_raw=print_raw,
-                speakers_expected=speakers_expected
-            )
+            async with pipeline_slot():
+                transcript_result = await transcription_service.transcribe_audio_async(
+                    audio_file.file,
+                    print_raw=print_raw,
+                    speakers_expected=speakers_expected,
+                    speaker_labels=speaker_labels
+                )
             
             transcript_text = transcript_result['text']
             
-            if not transcript_text or len(transcript_text.strip()) < 10:
+            rejection = transcript_rejection(transcript_result)
+            if rejection:
                 return jsonify({
-                    'error': 'Transcription too short or empty',
+                    'error': rejection,
                     'transcript': transcript_text
                 }), 400
             
@@ -350,20 +516,19 @@ def process_audio():
                 'details': str(e)
             }), 500
         finally:
-            # Clean up audio file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.debug(f"Orchestrator: Cleaned up temp file: {temp_path}")
+            # Release the audio buffer
+            audio_file.close()
 
         # Step 4: Extract structured data (Phase B)
         logger.info("Orchestrator: PHASE B — LLM Processing")
         
         try:
-            structured_data = llm_processor.extract_structured_data(
-                transcript_text,
-                utterances=transcript_result.get('utterances', []),
-                role_map=transcript_result.get('speaker_role_map', {})
-            )
+            async with pipeline_slot():
+                structured_data = await llm_processor.extract_structured_data_async(
+                    transcript_text,
+                    utterances=transcript_result.get('utterances', []),
+                    role_map=transcript_result.get('speaker_role_map', {})
+                )
             
             # Validate extracted data
             is_valid, error_msg = llm_processor.validate_against_schema(structured_data)
@@ -389,54 +554,145 @@ def process_audio():
         
         # Step 5: Prepare pending_review response
         session_id = f"SESSION-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-
-        utterances = transcript_result.get('utterances', [])
-        role_map = transcript_result.get('speaker_role_map', {})
-        def _role(u):
-            spk = u['speaker']
-            return role_map.get(spk, 'Hablante ' + spk)
-        labeled_text = "\n".join(
-            f"[{_role(u)}]: {u['text']}" for u in utterances
-        ) if utterances else None
-
-        transcript_payload = {
-            'text': transcript_text,
-            'labeled_text': labeled_text,
-            'confidence': transcript_result.get('confidence'),
-            'duration_seconds': transcript_result.get('audio_duration', 0) / 1000,
-            'word_count': transcript_result.get('words', 0),
-            'speaker_role_map': role_map
-        }
-
-        response = {
-            'session_id': session_id,
-            'status': 'pending_review',
-            'transcript': transcript_payload,
-            'structured_data': structured_data
-        }
+        response = review_response(session_id, transcript_result, structured_data)
 
         # Persist session — store extra fields (local_timestamp, create_doc,
         # consent) alongside the response so confirm_and_generate can read them.
         save_session(session_id, {
-            **response,
-            'local_timestamp': local_timestamp,
-            'create_doc': create_doc,
-            'consent_given': consent_given,
-            'consent_timestamp': consent_timestamp
+            **response, **session_extras,
+            'audio_cache_key': transcript_result.get('audio_cache_key')
         })
 
         logger.info(f"Orchestrator: Ready for review. Session: {session_id}")
         return jsonify(response), 200
 
     except Exception as e:
-        logger.error(f"Orchestrator: CRITICAL ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Orchestrator: CRITICAL ERROR: {str(e)}")
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
+    finally:
+        if audio_file:
+            audio_file.close()
+
+
+def transcript_rejection(transcript_result: dict) -> str | None:
+    """Why a transcript should not go to Gemini (empty, too short, too unreliable) — None if it may."""
+    transcript_text = transcript_result.get('text')
+    if not transcript_text or len(transcript_text.strip()) < Config.MIN_TRANSCRIPT_CHARS:
+        return 'Transcription too short or empty'
+    confidence = transcript_result.get('confidence')
+    if confidence is not None and confidence < Config.MIN_TRANSCRIPT_CONFIDENCE:
+        return f'Transcription confidence too low ({confidence:.0%})'
+    return None
+
+
+def review_response(session_id: str, transcript_result: dict, structured_data: dict) -> dict:
+    """pending_review payload shown to the doctor: transcript (role-labeled when available) + structured data."""
+    utterances = transcript_result.get('utterances', [])
+    role_map = transcript_result.get('speaker_role_map', {})
+    def _role(u):
+        spk = u['speaker']
+        return role_map.get(spk, 'Hablante ' + spk)
+    labeled_text = "\n".join(
+        f"[{_role(u)}]: {u['text']}" for u in utterances
+    ) if utterances else None
+
+    transcript_payload = {
+        'text': transcript_result['text'],
+        'labeled_text': labeled_text,
+        'confidence': transcript_result.get('confidence'),
+        'duration_seconds': transcript_result.get('audio_duration', 0) / 1000,
+        'word_count': transcript_result.get('words', 0),
+        'speaker_role_map': role_map
+    }
+
+    return {
+        'session_id': session_id,
+        'status': 'pending_review',
+        'transcript': transcript_payload,
+        'structured_data': structured_data
+    }
+
+
+@app.route('/api/assemblyai/webhook', methods=['POST'])
+def assemblyai_webhook():
+    """
+    AssemblyAI completion callback (webhook mode). Acknowledges at once — the
+    transcript fetch and Gemini extraction run in a background thread, since
+    AssemblyAI only waits a few seconds for the reply.
+    """
+    if not Config.ASSEMBLYAI_WEBHOOK_URL:
+        return jsonify({'error': 'Webhook mode is not enabled'}), 404
+    received = request.headers.get(WEBHOOK_AUTH_HEADER, '')
+    if not hmac.compare_digest(received.encode(), Config.ASSEMBLYAI_WEBHOOK_SECRET.encode()):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    payload = request.get_json(silent=True) or {}
+    session_id = request.args.get('session_id', '')
+    session = load_session(session_id)
+    if (not session or session.get('status') != 'transcribing'
+            or session.get('transcript_id') != payload.get('transcript_id')):
+        return jsonify({'error': 'Unknown or already completed session'}), 404
+    # A redelivered callback must not start a second fetch + Gemini run
+    if not claim_session(session_id, 'transcribing', 'processing'):
+        logger.info(f"Orchestrator: Duplicate webhook for {session_id} ignored")
+        return jsonify({'status': 'already_processing'}), 200
+
+    threading.Thread(
+        target=complete_transcription, args=(session, payload.get('status')), daemon=True
+    ).start()
+    return jsonify({'status': 'accepted'}), 200
+
+
+def complete_transcription(session: dict, status: str):
+    """
+    Phases A (fetch) and B (LLM) for a webhook-mode session. Leaves the session
+    in pending_review, exactly as the synchronous path would, or in failed.
+    """
+    session_id = session['session_id']
+    try:
+        if status != 'completed':
+            raise Exception(f"AssemblyAI reported status: {status}")
+        with _pipeline_slots:
+            transcript_result = transcription_service.fetch_result(
+                session['transcript_id'], print_raw=session.get('print_raw', False)
+            )
+
+        transcript_text = transcript_result['text']
+        rejection = transcript_rejection(transcript_result)
+        if rejection:
+            raise ValueError(rejection)
+
+        with _pipeline_slots:
+            structured_data = llm_processor.extract_structured_data(
+                transcript_text,
+                utterances=transcript_result.get('utterances', []),
+                role_map=transcript_result.get('speaker_role_map', {})
+            )
+
+        is_valid, error_msg = llm_processor.validate_against_schema(structured_data)
+        if not is_valid:
+            logger.warning(f"Orchestrator: Data validation failed: {error_msg}")
+
+        # Inject consultation timestamp (NOM-004 compliance)
+        structured_data.setdefault('metadata', {})['fecha_hora_consulta'] = session['consultation_timestamp']
+
+        response = review_response(session_id, transcript_result, structured_data)
+        save_session(session_id, {
+            **response,
+            'local_timestamp': session['local_timestamp'],
+            'create_doc': session['create_doc'],
+            'consent_given': session['consent_given'],
+            'consent_timestamp': session['consent_timestamp']
+        })
+        logger.info(f"Orchestrator: Ready for review. Session: {session_id}")
+
+    except Exception as e:
+        logger.exception(f"Orchestrator: Webhook processing failed for {session_id}: {str(e)}")
+        save_session(session_id, {**session, 'status': 'failed', 'error': str(e)})
 
 
 @app.route('/api/confirm-and-generate', methods=['POST'])
-def confirm_and_generate():
+async def confirm_and_generate():
     """
     Receives doctor-reviewed structured_data, creates Google Doc, returns final response.
     Expected JSON: { "session_id": "...", "structured_data": {...}, "create_doc": true }
@@ -480,36 +736,51 @@ def confirm_and_generate():
                     'error': 'Esta nota ha sido cancelada por solicitud ARCO y no puede modificarse.',
                     'error_code': 'SESSION_CANCELLED'
                 }), 409
+            # Webhook mode: still transcribing/processing, or failed — nothing to confirm yet
+            if row and row[0] != 'pending_review':
+                return jsonify({
+                    'error': 'Esta nota todavía no está lista para revisión.',
+                    'error_code': 'SESSION_NOT_READY'
+                }), 409
         except Exception as e:
             logger.warning(f"DB: Could not check session lock status: {e}")
 
         local_timestamp = session.get('local_timestamp', datetime.now().strftime("%Y-%m-%d %H:%M"))
 
-        doc_info = None
-        if create_doc:
+        async def build_doc():
+            if not create_doc:
+                return None
             logger.info("Orchestrator: PHASE C — Google Docs Generation")
             try:
-                docs_generator = GoogleDocsGenerator()
+                docs_generator = get_docs_generator()
                 patient_name = structured_data.get('informacion_paciente', {}).get(
                     'nombre_del_paciente', 'Paciente'
                 )
                 doc_title = f"ClinIA - {patient_name} - {local_timestamp}"
-                doc_info = docs_generator.create_medical_note(structured_data, title=doc_title)
-                logger.info(f"Orchestrator: Google Doc created: {doc_info['link']}")
+                async with pipeline_slot():
+                    doc = await docs_generator.create_medical_note_async(structured_data, title=doc_title)
+                logger.info(f"Orchestrator: Google Doc created: {doc['link']}")
+                return doc
             except Exception as e:
                 logger.error(f"Orchestrator: Google Docs creation failed: {str(e)}")
-                doc_info = {'error': 'Failed to create Google Doc', 'details': str(e)}
+                return {'error': 'Failed to create Google Doc', 'details': str(e)}
 
         # PDF generation (if requested) — runs independently of Google Docs
-        pdf_bytes = None
-        if create_pdf:
+        async def build_pdf():
+            if not create_pdf:
+                return None
             logger.info("Orchestrator: PHASE C2 — PDF Generation")
             try:
-                pdf_bytes = pdf_generator.generate_pdf(structured_data, session_id=session_id)
-                logger.info(f"PDF: Generated successfully — {len(pdf_bytes)} bytes")
+                pdf = await asyncio.to_thread(pdf_generator.generate_pdf, structured_data, session_id=session_id)
+                logger.info(f"PDF: Generated successfully — {len(pdf)} bytes")
+                return pdf
             except Exception as e:
                 logger.warning(f"PDF: Generation failed: {str(e)}")
                 # Never raise — PDF failure must not block the pipeline
+                return None
+
+        # Docs round-trips and PDF rendering overlap instead of running back to back
+        doc_info, pdf_bytes = await asyncio.gather(build_doc(), build_pdf())
 
         response = {
             'session_id': session_id,
@@ -593,9 +864,7 @@ def confirm_and_generate():
         return jsonify(response), 200
 
     except Exception as e:
-        logger.error(f"Orchestrator: CRITICAL ERROR in confirm: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Orchestrator: CRITICAL ERROR in confirm: {str(e)}")
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
 
@@ -605,21 +874,20 @@ def transcribe_only():
     Endpoint for transcription only (no LLM processing)
     Useful for testing and verification
     """
+    audio_file = None
     try:
-        if 'audio' not in request.files:
+        audio_file, form = receive_audio_upload()
+        if not audio_file or not audio_file.multipart_filename:
             return jsonify({'error': 'No audio file provided'}), 400
         
-        audio_file = request.files['audio']
-        print_raw = request.form.get('print_raw', 'true').lower() == 'true'
-        
-        # Save to temp file
-        filename = secure_filename(audio_file.filename)
-        temp_path = os.path.join(tempfile.gettempdir(), filename)
-        audio_file.save(temp_path)
+        print_raw = form.get('print_raw', 'true').lower() == 'true'
+        speaker_labels = form.get('speaker_labels', str(print_raw)).lower() == 'true'
         
         try:
             # Transcribe
-            result = transcription_service.transcribe_audio(temp_path, print_raw=print_raw)
+            result = transcription_service.transcribe_audio(
+                audio_file.file, print_raw=print_raw, speaker_labels=speaker_labels
+            )
             
             return jsonify({
                 'status': 'success',
@@ -627,14 +895,16 @@ def transcribe_only():
             }), 200
             
         finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            audio_file.close()
     
     except Exception as e:
         return jsonify({
             'error': 'Transcription failed',
             'details': str(e)
         }), 500
+    finally:
+        if audio_file:
+            audio_file.close()
 
 
 @app.route('/api/process-transcript', methods=['POST'])
@@ -642,6 +912,7 @@ def process_transcript():
     """
     Process a raw transcript (for testing LLM without audio).
     Expected JSON: {"transcript": "text here"}
+    Optional: "use_cache": false forces a fresh Gemini extraction.
     Note: this endpoint does not create a persistent session — it is a
     one-shot testing utility and has never written to session storage.
     """
@@ -654,14 +925,16 @@ def process_transcript():
         transcript = data['transcript']
         
         # Process with LLM
-        structured_data = llm_processor.extract_structured_data(transcript)
+        structured_data = llm_processor.extract_structured_data(
+            transcript, use_cache=data.get('use_cache', True)
+        )
         
         # Optionally create document
         create_doc = data.get('create_doc', False)
         doc_info = None
         
         if create_doc:
-            docs_generator = GoogleDocsGenerator()
+            docs_generator = get_docs_generator()
             doc_info = docs_generator.create_medical_note(structured_data)
         
         return jsonify({
@@ -677,6 +950,36 @@ def process_transcript():
         }), 500
 
 
+@app.route('/api/process-transcript/stream', methods=['POST'])
+def process_transcript_stream():
+    """
+    Streaming twin of /api/process-transcript (Server-Sent Events).
+    Expected JSON: {"transcript": "text here"}
+    Emits 'chunk' events with the JSON text as Gemini generates it, then one
+    'result' event with the parsed structured_data (same shape as the
+    non-streaming endpoint). Each event's data is a JSON value.
+    """
+    data = request.get_json(silent=True)
+    if not data or 'transcript' not in data:
+        return jsonify({'error': 'No transcript provided'}), 400
+    transcript = data['transcript']
+
+    def events():
+        try:
+            for event, payload in llm_processor.extract_structured_data_stream(transcript):
+                yield f"event: {event}\ndata: {orjson.dumps(payload).decode('utf-8')}\n\n"
+        except Exception as e:
+            logger.error(f"LLM: Stream aborted: {e}")
+            error = {'error': 'Processing failed', 'details': str(e)}
+            yield f"event: error\ndata: {orjson.dumps(error).decode('utf-8')}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
 @app.route('/api/session/<session_id>', methods=['GET'])
 def get_session(session_id):
     """Retrieve session data by ID"""
@@ -714,6 +1017,15 @@ def cancel_session(session_id):
         conn.commit()
         conn.close()
         logger.info(f"DB: Session {session_id} blocked — ARCO Cancelación request.")
+
+        # The transcript and extraction caches hold their own copies of the
+        # transcript and note — drop them too
+        session = load_session(session_id) or {}
+        transcription_service.forget_transcript(session.get('audio_cache_key'))
+        transcript = session.get('transcript') or {}
+        transcript_content = transcript.get('labeled_text') or transcript.get('text')
+        if transcript_content:
+            llm_processor.forget_extraction(transcript_content)
         return jsonify({
             'status': 'cancelled',
             'session_id': session_id,
@@ -793,7 +1105,7 @@ def export_json(session_id):
         return jsonify({'error': 'Session not found'}), 404
 
     response = app.response_class(
-        response=json.dumps(data, indent=2, ensure_ascii=False),
+        response=orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS),
         mimetype='application/json'
     )
     response.headers['Content-Disposition'] = f'attachment; filename=clinia_{session_id}.json'
@@ -813,11 +1125,11 @@ def download_pdf(session_id):
 
         # Debug logging — reveals session_id mismatches in Render logs
         logger.info(f"PDF: Download requested for session: {session_id}")
-        cursor.execute(
-            'SELECT session_id, pdf_data IS NOT NULL as has_pdf FROM sessions ORDER BY rowid DESC LIMIT 5'
-        )
-        recent = cursor.fetchall()
-        logger.debug(f"PDF: Recent sessions in DB: {recent}")
+        if logger.isEnabledFor(logging.DEBUG):
+            cursor.execute(
+                'SELECT session_id, pdf_data IS NOT NULL as has_pdf FROM sessions ORDER BY rowid DESC LIMIT 5'
+            )
+            logger.debug("PDF: Recent sessions in DB: %s", cursor.fetchall())
 
         cursor.execute(
             'SELECT pdf_data FROM sessions WHERE session_id = ?',
@@ -874,32 +1186,12 @@ def internal_server_error(error):
     }), 500
 
 # remove per Gemini
-# if __name__ == '__main__':
-#     print("\n" + "="*80)
-#     print("ClinIA Alpha - Medical Note Taker")
-#     print("="*80)
-#     print("Starting Flask server...")
-#     print("Frontend will be available at: http://localhost:5000")
-#     print("API endpoints:")
-#     print("  - POST /api/process-audio      (Full pipeline)")
-#     print("  - POST /api/transcribe-only    (Transcription only)"
-#     print("  - POST /api/process-transcript (LLM processing only)")
-#     print("  - GET  /api/health             (Health check)")
-#     print("="*80 + "\n")
-
 if __name__ == '__main__':
     # This block only runs when you run 'python app.py' on your computer.
-    # It does NOT run on Render.
+    # It does NOT run on Render — production is served by gunicorn (see Procfile / Dockerfile).
     logger.info("ClinIA Beta - Medical Note Taker (Local Mode) — starting Flask server")
     
     # We use port 5000 locally, but Render will assign its own port via environment variables
     port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
-
-    
-    # Run Flask development server
-#     app.run(
-#         host='0.0.0.0',
-#         port=5000,
-#         debug=True
-#     )
+    debug = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
+    app.run(host='0.0.0.0', port=port, debug=debug)
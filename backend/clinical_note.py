@@ -0,0 +1,86 @@
+# backend/clinical_note.py
+# Pydantic model of the SOAP note Gemini returns (mirrors schema.json).
+# Passed as response_schema so the API enforces the structure at decode time.
+#
+# Fields filled by the backend rather than the LLM (codigo_cie11 / titulo_cie11
+# from the WHO ICD API, metadata.fecha_hora_consulta from the client clock) are
+# deliberately absent, so the model is never asked to produce them.
+
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class InformacionPaciente(BaseModel):
+    nombre_del_paciente: Optional[str] = None
+    fecha_de_nacimiento: Optional[str] = None
+    edad: Optional[str] = None
+    genero: Optional[str] = None
+    numero_expediente: Optional[str] = None
+    curp: Optional[str] = None
+
+
+class Subjetivo(BaseModel):
+    motivo_de_consulta: Optional[str] = None
+    sintomas: Optional[List[str]] = None
+    historia_de_enfermedad_actual: Optional[str] = None
+    duracion_sintomas: Optional[str] = None
+
+
+class SignosVitales(BaseModel):
+    presion_arterial: Optional[str] = None
+    frecuencia_cardiaca: Optional[str] = None
+    temperatura: Optional[str] = None
+    frecuencia_respiratoria: Optional[str] = None
+    saturacion_oxigeno: Optional[str] = None
+    peso: Optional[str] = None
+    talla: Optional[str] = None
+
+
+class Objetivo(BaseModel):
+    signos_vitales: Optional[SignosVitales] = None
+    habitus_exterior: Optional[str] = None
+    examen_fisico: Optional[str] = None
+    hallazgos: Optional[List[str]] = None
+
+
+class Evaluacion(BaseModel):
+    diagnostico: Optional[str] = None
+    diagnosticos_adicionales: Optional[List[str]] = None
+    impresion_clinica: Optional[str] = None
+    pronostico: Optional[str] = None
+
+
+class Medicamento(BaseModel):
+    nombre: Optional[str] = None
+    dosis: Optional[str] = None
+    frecuencia: Optional[str] = None
+    duracion: Optional[str] = None
+
+
+class Plan(BaseModel):
+    tratamiento: Optional[str] = None
+    medicamentos: Optional[List[Medicamento]] = None
+    recomendaciones: Optional[List[str]] = None
+    estudios_solicitados: Optional[List[str]] = None
+    seguimiento: Optional[str] = None
+
+
+class Metadata(BaseModel):
+    fecha_consulta: Optional[str] = None
+    medico: Optional[str] = None
+    duracion_consulta: Optional[str] = None
+
+
+class ActualizacionAntecedentes(BaseModel):
+    detectado: Optional[bool] = None
+    contenido: Optional[str] = None
+
+
+class ClinicalNote(BaseModel):
+    informacion_paciente: InformacionPaciente
+    subjetivo: Optional[Subjetivo] = None
+    objetivo: Optional[Objetivo] = None
+    evaluacion: Optional[Evaluacion] = None
+    plan: Optional[Plan] = None
+    metadata: Optional[Metadata] = None
+    actualizacion_antecedentes: Optional[ActualizacionAntecedentes] = None
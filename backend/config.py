@@ -49,9 +49,63 @@ class Config:
     }
     MAX_AUDIO_SIZE_BYTES = 200 * 1024 * 1024  # 200 MB
     MIN_AUDIO_SIZE_BYTES = 1024               # 1 KB — reject empty or near-empty files
+    AUDIO_SPOOL_MAX_BYTES = 16 * 1024 * 1024  # uploads up to 16 MB stay in RAM, larger spill to disk
     
+    # AssemblyAI webhook mode — opt-in. When set, /api/process-audio submits the audio
+    # and returns 202; AssemblyAI calls this URL when the transcript is ready and the
+    # client polls /api/session/<id>. The secret authenticates those callbacks.
+    ASSEMBLYAI_WEBHOOK_URL = os.getenv('ASSEMBLYAI_WEBHOOK_URL', '')
+    ASSEMBLYAI_WEBHOOK_SECRET = os.getenv('ASSEMBLYAI_WEBHOOK_SECRET', '')
+
+    # Parallel uploads in TranscriptionService.transcribe_many
+    TRANSCRIPTION_UPLOAD_WORKERS = int(os.getenv('TRANSCRIPTION_UPLOAD_WORKERS', 8))
+
+    # Transcripts below either threshold skip the Gemini call (silence, failed audio, noise)
+    MIN_TRANSCRIPT_CHARS = int(os.getenv('MIN_TRANSCRIPT_CHARS', 40))
+    MIN_TRANSCRIPT_CONFIDENCE = float(os.getenv('MIN_TRANSCRIPT_CONFIDENCE', 0.3))
+
     # Language
     PRIMARY_LANGUAGE = 'es'  # Spanish
+
+    # LLM extraction cache — one JSON file per (model, prompt version, transcript). Opt-in:
+    # entries are full clinical notes (LFPDPPP patient data); ARCO cancellation evicts them
+    EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR', '')
+    EXTRACTION_CACHE_TTL_SECONDS = int(os.getenv('EXTRACTION_CACHE_TTL_SECONDS', 30 * 24 * 3600))  # 0 = never expire
+
+    # AssemblyAI transcript cache keyed by audio content — opt-in: transcripts are patient
+    # data (LFPDPPP), so they are only kept on disk when a directory is configured
+    TRANSCRIPT_CACHE_DIR = os.getenv('TRANSCRIPT_CACHE_DIR', '')
+    TRANSCRIPT_CACHE_TTL_SECONDS = int(os.getenv('TRANSCRIPT_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+
+    # Semantic (embedding) tier of the extraction cache — opt-in, needs sentence-transformers
+    SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+    SEMANTIC_CACHE_MODEL = os.getenv('SEMANTIC_CACHE_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.90))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 2048))
+    SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv('SEMANTIC_CACHE_TTL_SECONDS', 24 * 3600))
+
+    # Gemini explicit context cache for the SOAP system instruction — opt-in
+    # (implicit prefix caching already applies; explicit caching bills cache storage)
+    GEMINI_CONTEXT_CACHE_ENABLED = os.getenv('GEMINI_CONTEXT_CACHE_ENABLED', 'false').lower() == 'true'
+    GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL_SECONDS', 3600))
+
+    # Gemini retries on 429/5xx/timeouts — separate from the JSON-error attempts
+    LLM_TRANSIENT_RETRIES = int(os.getenv('LLM_TRANSIENT_RETRIES', 5))
+    LLM_BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE_SECONDS', 1.0))
+    LLM_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', 30.0))
+
+    # Cap on Gemini output per extraction. On gemini-2.5-flash thinking tokens count
+    # against it, so it sits well above the ~1k tokens of the note itself
+    LLM_MAX_OUTPUT_TOKENS = int(os.getenv('LLM_MAX_OUTPUT_TOKENS', 8192))
+
+    # Max concurrent Gemini calls in a batch (LLMProcessor.extract_many)
+    LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+
+    # Transcripts longer than this many input tokens are trimmed to head + tail (0 = never)
+    LLM_MAX_INPUT_TOKENS = int(os.getenv('LLM_MAX_INPUT_TOKENS', 24000))
+
+    # Pipeline — max transcription/LLM/Docs calls in flight at once per worker
+    PIPELINE_MAX_CONCURRENCY = int(os.getenv('PIPELINE_MAX_CONCURRENCY', 8))
     
     @classmethod
     def validate(cls):
@@ -63,6 +117,9 @@ class Config:
         
         if not cls.GEMINI_API_KEY:
             errors.append("GEMINI_API_KEY is required")
+
+        if cls.ASSEMBLYAI_WEBHOOK_URL and not cls.ASSEMBLYAI_WEBHOOK_SECRET:
+            errors.append("ASSEMBLYAI_WEBHOOK_SECRET is required when ASSEMBLYAI_WEBHOOK_URL is set")
         
         if errors:
             raise ValueError(f"Configuration errors: {', '.join(errors)}")
@@ -1,7 +1,11 @@
 # backend/docs_generator.py
-# modify flow; add teleporter
 import os
-import json
+import orjson
+import asyncio
+import threading
+from functools import lru_cache
+import httplib2
+import google_auth_httplib2
 from typing import Dict, List
 from logger import logger
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -9,10 +13,87 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
 # ID of your template (Must be a native Google Doc)
 TEMPLATE_ID = '1XVXnvw6JiAg1If3BUJtaAIrLdcpujAlovHVPyuUny1A'
 
+GOOGLE_API_TIMEOUT = 60  # seconds
+
+# SOAP body of the note: (section title, structured_data key, entries).
+# Each entry is (kind, label, keys); keys are tried in order (fallback names the LLM
+# sometimes uses). Kinds:
+#   inline      bold label + value on the same line
+#   inline_opt  same, omitted when the value is empty
+#   block       bold label line, value on the next line
+#   plain_opt   "label value" in normal weight, omitted when empty
+#   bullets     bold label line, one " • item" line per list element
+#   vitals      signos_vitales dict rendered as "T/A: x, FC: y" (or "No registrados")
+#   cie11       CIE-11 code, followed by titulo_cie11 when present
+_SOAP_LAYOUT = (
+    ('SUBJETIVO (S)', 'subjetivo', (
+        ('inline',     'Motivo de Consulta: ',         ('motivo_de_consulta',)),
+        ('bullets',    'Síntomas: ',                   ('sintomas',)),
+        ('block',      'Historia de la Enfermedad: ',  ('historia_de_enfermedad_actual',)),
+        ('plain_opt',  'Duración de síntomas: ',       ('duracion_sintomas',)),
+    )),
+    ('OBJETIVO (O)', 'objetivo', (
+        ('vitals',     'Signos Vitales: ',             ('signos_vitales',)),
+        ('block',      'Examen Físico: ',              ('examen_fisico',)),
+        ('block',      'Hallazgos: ',                  ('hallazgos',)),
+        ('inline_opt', 'Habitus Exterior: ',           ('habitus_exterior',)),
+    )),
+    ('EVALUACIÓN (A) -- Assessment', 'evaluacion', (
+        ('inline',     'Diagnóstico: ',                ('diagnostico', 'diagnostico_principal')),
+        ('cie11',      'Código CIE-11: ',              ('codigo_cie11',)),
+        ('inline',     'Impresión Clínica: ',          ('impresion_clinica',)),
+        ('inline_opt', 'Pronóstico: ',                 ('pronostico',)),
+    )),
+    ('PLAN (P)', 'plan', (
+        ('bullets',    'Medicamentos Prescritos:',     ('medicamentos', 'medicamentos_prescritos')),
+        ('block',      'Tratamiento: ',                ('tratamiento',)),
+        ('bullets',    'Recomendaciones:',             ('recomendaciones',)),
+        ('bullets',    'Estudios Solicitados:',        ('estudios_solicitados',)),
+        ('block',      'Seguimiento:',                 ('seguimiento',)),
+    )),
+)
+
+# Rule framing the SOAP summary heading
+_RULE = "-" * 80
+
+_VITALES_LABELS = {
+    'presion_arterial':        'T/A',
+    'frecuencia_cardiaca':     'FC',
+    'temperatura':             'Temp',
+    'frecuencia_respiratoria': 'FR',
+    'saturacion_oxigeno':      'SpO₂',
+    'peso':                    'Peso',
+    'talla':                   'Talla',
+}
+
+
+@lru_cache(maxsize=4)
+def _read_json_file(path: str, mtime_ns: int) -> Dict:
+    """Parsed JSON for (path, mtime) — a rewritten or rotated file gets a new cache key."""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def _load_json_file(path: str) -> Dict | None:
+    """Contents of a local credentials file, re-read only when its mtime changes. None if missing."""
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _read_json_file(path, mtime_ns)
+
+
+def _bullet_text(item) -> str:
+    """Medication dicts render as 'nombre - dosis (frecuencia)'; anything else as-is."""
+    if isinstance(item, dict):
+        return f"{item.get('nombre')} - {item.get('dosis')} ({item.get('frecuencia')})"
+    return str(item)
+
 class GoogleDocsGenerator:
     """Generates Medical Notes with strict bolding control and range validation."""
     def __init__(self, owner_email: str = None):
@@ -29,15 +110,16 @@ class GoogleDocsGenerator:
         if token_env:
             try:
                 # Load the token directly from the string variable
-                token_info = json.loads(token_env)
+                token_info = orjson.loads(token_env)
                 creds = Credentials.from_authorized_user_info(token_info, SCOPES)
                 logger.info("GoogleDocs: Using token from Environment Variable.")
             except Exception as e:
                 logger.error(f"GoogleDocs: Error loading token from env: {e}")
 
         # PRIORITY 2: Check for local file (Your Laptop Alpha Way)
-        if not creds and os.path.exists('token.json'):
-            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        token_info = _load_json_file('token.json') if not creds else None
+        if token_info:
+            creds = Credentials.from_authorized_user_info(token_info, SCOPES)
             logger.info("GoogleDocs: Using local token.json file.")
 
         # REFRESH logic: If the token is old, try to refresh it automatically
@@ -57,13 +139,55 @@ class GoogleDocsGenerator:
                 raise Exception("Critical: No Google Credentials found in Environment Variables!")
             
             logger.info("GoogleDocs: No valid credentials found locally. Starting login flow...")
-            flow = InstalledAppFlow.from_client_secrets_file('client_secrets.json', SCOPES)
+            # OAuth client config straight from the environment when set, else the local file
+            secrets_env = os.environ.get('GOOGLE_SECRETS_JSON')
+            client_config = orjson.loads(secrets_env) if secrets_env else _load_json_file('client_secrets.json')
+            if client_config is None:
+                raise Exception("Critical: client_secrets.json not found — cannot start the Google login flow.")
+            flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
             creds = flow.run_local_server(port=0) 
             with open('token.json', 'w') as token:
                 token.write(creds.to_json())
 
-        self.docs_service = build('docs', 'v1', credentials=creds)
-        self.drive_service = build('drive', 'v3', credentials=creds)
+        # httplib2.Http is not thread-safe, so each worker thread gets its own
+        # authorized connection, kept alive across notes (no TLS handshake per call)
+        self._creds = creds
+        self._thread_local = threading.local()
+        self.docs_service = build(
+            'docs', 'v1', http=self._authorized_http(), requestBuilder=self._build_request
+        )
+        self.drive_service = build(
+            'drive', 'v3', http=self._authorized_http(), requestBuilder=self._build_request
+        )
+
+        # A fresh copy has the same body as the template, so its insertion
+        # point is read once here instead of with a documents().get per note
+        try:
+            self._template_start_index = self._read_start_index(TEMPLATE_ID)
+        except HttpError as error:
+            logger.warning(f"GoogleDocs: Could not read template end index, will read per note: {error}")
+            self._template_start_index = None
+
+    def _authorized_http(self) -> google_auth_httplib2.AuthorizedHttp:
+        """Persistent per-thread HTTP connection carrying the OAuth credentials."""
+        http = getattr(self._thread_local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(
+                self._creds, http=httplib2.Http(timeout=GOOGLE_API_TIMEOUT)
+            )
+            self._thread_local.http = http
+        return http
+
+    def _build_request(self, http, *args, **kwargs) -> HttpRequest:
+        """requestBuilder hook — routes every API call through the calling thread's connection."""
+        return HttpRequest(self._authorized_http(), *args, **kwargs)
+
+    def _read_start_index(self, document_id: str) -> int:
+        """Index just before the document's final newline — where the note body is inserted."""
+        document = self.docs_service.documents().get(
+            documentId=document_id, fields='body(content(endIndex))'
+        ).execute()
+        return document.get('body').get('content')[-1].get('endIndex') - 1
 
     def create_medical_note(self, structured_data: Dict, title: str = None) -> Dict:
         """Copies the template and applies the SOAP summary with selective bolding."""
@@ -78,18 +202,32 @@ class GoogleDocsGenerator:
             copied_file = self.drive_service.files().copy(fileId=TEMPLATE_ID, body=copy_body).execute()
             doc_id = copied_file.get('id')
             
-            # 2. Get the index to start writing after the header
-            document = self.docs_service.documents().get(documentId=doc_id).execute()
-            start_index = document.get('body').get('content')[-1].get('endIndex') - 1
+            # 2. Index to start writing after the header (cached from the template)
+            start_index = self._template_start_index
+            if start_index is None:
+                start_index = self._read_start_index(doc_id)
             
             # 3. Build the requests using the helper method
             requests = self._build_document_requests(structured_data, start_index)
             
             if requests:
-                self.docs_service.documents().batchUpdate(
-                    documentId=doc_id,
-                    body={'requests': requests}
-                ).execute()
+                try:
+                    self.docs_service.documents().batchUpdate(
+                        documentId=doc_id,
+                        body={'requests': requests}
+                    ).execute()
+                except HttpError as error:
+                    # Template edited since startup — re-read the index once and retry
+                    if error.resp.status != 400 or self._template_start_index is None:
+                        raise
+                    logger.warning("GoogleDocs: Cached template index rejected, re-reading document")
+                    start_index = self._read_start_index(doc_id)
+                    self._template_start_index = start_index
+                    requests = self._build_document_requests(structured_data, start_index)
+                    self.docs_service.documents().batchUpdate(
+                        documentId=doc_id,
+                        body={'requests': requests}
+                    ).execute()
             
             link = f"https://docs.google.com/document/d/{doc_id}/edit"
             logger.info(f"GoogleDocs: Document created successfully: {link}")
@@ -99,9 +237,18 @@ class GoogleDocsGenerator:
             logger.error(f"GoogleDocs: API Error: {error}")
             raise
 
+    async def create_medical_note_async(self, structured_data: Dict, title: str = None) -> Dict:
+        """Async wrapper — google-api-python-client is sync, so the copy/get/batchUpdate run in a worker thread."""
+        return await asyncio.to_thread(self.create_medical_note, structured_data, title)
+
     def _build_document_requests(self, data: Dict, start_index: int = 1) -> List[Dict]:
-        """Constructs document requests ensuring specific labels are bold and content is normal."""
-        requests = []
+        """
+        Constructs document requests ensuring specific labels are bold and content is normal.
+        The note is inserted with a single insertText; bold labels are applied afterwards as
+        merged ranges, so the batch stays small and the server never re-shifts indexes.
+        """
+        parts = []
+        bold_ranges = []
         index = start_index 
         
         info = data.get('informacion_paciente', {})
@@ -109,25 +256,22 @@ class GoogleDocsGenerator:
 
         # --- Formatting Helper ---
         def add_text(text: str, bold: bool = False, newline: bool = True):
-            nonlocal index, requests
+            nonlocal index
             text_str = str(text) if text is not None else ""
             content = text_str + ('\n' if newline else '')
             
             if not content:
                 return
 
-            # Insert the raw text
-            requests.append({'insertText': {'location': {'index': index}, 'text': content}})
-            
-            # CRITICAL: Only apply style if text length > 0 to prevent HttpError 400
-            if len(text_str) > 0:
-                requests.append({
-                    'updateTextStyle': {
-                        'range': {'startIndex': index, 'endIndex': index + len(text_str)},
-                        'textStyle': {'bold': bold},
-                        'fields': 'bold'
-                    }
-                })
+            parts.append(content)
+
+            # CRITICAL: Only track styled ranges with length > 0 to prevent HttpError 400
+            if bold and text_str:
+                end = index + len(text_str)
+                if bold_ranges and bold_ranges[-1][1] == index:
+                    bold_ranges[-1] = (bold_ranges[-1][0], end)  # merge adjacent bold runs
+                else:
+                    bold_ranges.append((index, end))
             
             index += len(content)
 
@@ -147,119 +291,71 @@ class GoogleDocsGenerator:
         add_text(f"DOMICILIO: {info.get('domicilio', '________________________________________')}", bold=False)
         add_text(f"TEL: {info.get('telefono', '__________')}\t\tCELULAR: {info.get('celular', '__________')}", bold=False)
 
-        add_text("-" * 80, bold=False)
+        add_text(_RULE, bold=False)
         add_text("RESUMEN DE CONSULTA (SOAP)", bold=False)
-        add_text("-" * 80 + "\n", bold=False)
-
-        # --- 2. SUBJETIVO (S) ---
-        add_text('SUBJETIVO (S)', bold=True)
-        subj = data.get('subjetivo', {})
-        
-        add_text("Motivo de Consulta: ", bold=True, newline=False)
-        add_text(subj.get('motivo_de_consulta', ''), bold=False)
-        
-        add_text("Síntomas: ", bold=True)
-        sintomas = subj.get('sintomas', [])
-        if isinstance(sintomas, list):
-            for s in sintomas: add_text(f" • {s}", bold=False)
-        
-        add_text("Historia de la Enfermedad: ", bold=True)
-        add_text(subj.get('historia_de_enfermedad_actual', ''), bold=False)
-        
-        if subj.get('duracion_sintomas'):
-            add_text(f"Duración de síntomas: {subj['duracion_sintomas']}", bold=False)
-        
-        add_text("")
-
-        # --- 3. OBJETIVO (O) ---
-        add_text('OBJETIVO (O)', bold=True)
-        obj = data.get('objetivo', {})
-        
-        add_text("Signos Vitales: ", bold=True, newline=False)
-        v = obj.get('signos_vitales', {})
-        _vitales_labels = {
-            'presion_arterial':        'T/A',
-            'frecuencia_cardiaca':     'FC',
-            'temperatura':             'Temp',
-            'frecuencia_respiratoria': 'FR',
-            'saturacion_oxigeno':      'SpO₂',
-            'peso':                    'Peso',
-            'talla':                   'Talla',
-        }
-        vitales_str = ", ".join([
-            f"{_vitales_labels.get(k, k.replace('_', ' ').title())}: {val}"
-            for k, val in v.items() if val
-        ])
-        add_text(vitales_str if vitales_str else "No registrados", bold=False)
-
-        add_text("Examen Físico: ", bold=True)
-        add_text(obj.get('examen_fisico', ''), bold=False)
-        
-        add_text("Hallazgos: ", bold=True)
-        add_text(obj.get('hallazgos', ''), bold=False)
-
-        if obj.get('habitus_exterior'):
-            add_text("Habitus Exterior: ", bold=True, newline=False)
-            add_text(obj.get('habitus_exterior', ''), bold=False)
+        add_text(_RULE + "\n", bold=False)
 
-        add_text("")
+        # --- 2-5. SOAP SECTIONS (see _SOAP_LAYOUT) ---
+        for n, (title, section_key, entries) in enumerate(_SOAP_LAYOUT):
+            if n:
+                add_text("")
+            add_text(title, bold=True)
+            section = data.get(section_key) or {}
 
-        # --- 4. EVALUACIÓN (A) -- Assessment ---
-        add_text('EVALUACIÓN (A) -- Assessment', bold=True)
-        ev = data.get('evaluacion', {})
-        
-        add_text("Diagnóstico: ", bold=True, newline=False)
-        add_text(ev.get('diagnostico', ev.get('diagnostico_principal', '')), bold=False)
-
-        cie11_code  = ev.get('codigo_cie11', '')
-        cie11_title = ev.get('titulo_cie11', '')
-        if cie11_code:
-            add_text("Código CIE-11: ", bold=True, newline=False)
-            cie11_rest = cie11_code
-            if cie11_title:
-                cie11_rest += f'  —  {cie11_title}'
-            add_text(cie11_rest, bold=False)
-
-        add_text("Impresión Clínica: ", bold=True, newline=False)
-        add_text(ev.get('impresion_clinica', ''), bold=False)
-
-        if ev.get('pronostico'):
-            add_text("Pronóstico: ", bold=True, newline=False)
-            add_text(ev.get('pronostico', ''), bold=False)
-
-        add_text("")
-
-        # --- 5. PLAN (P) ---
-        add_text('PLAN (P)', bold=True)
-        plan = data.get('plan', {})
-        
-        add_text("Medicamentos Prescritos:", bold=True)
-        meds = plan.get('medicamentos', plan.get('medicamentos_prescritos', []))
-        if isinstance(meds, list):
-            for m in meds:
-                if isinstance(m, dict):
-                    content = f" • {m.get('nombre')} - {m.get('dosis')} ({m.get('frecuencia')})"
-                    add_text(content, bold=False)
-                else:
-                    add_text(f" • {m}", bold=False)
+            for kind, label, keys in entries:
+                value = next((section[k] for k in keys if k in section), '')
 
-#add "tratamiento"
+                if kind == 'inline':
+                    add_text(label, bold=True, newline=False)
+                    add_text(value, bold=False)
+                elif kind == 'inline_opt':
+                    if value:
+                        add_text(label, bold=True, newline=False)
+                        add_text(value, bold=False)
+                elif kind == 'block':
+                    add_text(label, bold=True)
+                    add_text(value, bold=False)
+                elif kind == 'plain_opt':
+                    if value:
+                        add_text(f"{label}{value}", bold=False)
+                elif kind == 'bullets':
+                    add_text(label, bold=True)
+                    items = value if isinstance(value, list) else ([value] if value else [])
+                    for item in items:
+                        add_text(f" • {_bullet_text(item)}", bold=False)
+                elif kind == 'vitals':
+                    add_text(label, bold=True, newline=False)
+                    vitales_str = ", ".join([
+                        f"{_VITALES_LABELS.get(k, k.replace('_', ' ').title())}: {val}"
+                        for k, val in (value or {}).items() if val
+                    ])
+                    add_text(vitales_str if vitales_str else "No registrados", bold=False)
+                elif kind == 'cie11':
+                    if value:
+                        add_text(label, bold=True, newline=False)
+                        cie11_title = section.get('titulo_cie11', '')
+                        add_text(f'{value}  —  {cie11_title}' if cie11_title else value, bold=False)
 
-        add_text("Tratamiento: ", bold=True)
-        add_text(plan.get('tratamiento', ''), bold=False)
-
-# end adding        
-        
-        add_text("Recomendaciones:", bold=True)
-        for r in plan.get('recomendaciones', []):
-            add_text(f" • {r}", bold=False)
-        
-        add_text("Estudios Solicitados:", bold=True)
-        estudios = plan.get('estudios_solicitados', [])
-        for e in (estudios if isinstance(estudios, list) else [estudios]):
-            add_text(f" • {e}", bold=False)
-            
-        add_text("Seguimiento:", bold=True)
-        add_text(plan.get('seguimiento', ''), bold=False)
+        if not parts:
+            return []
 
+        # One insert for the whole note, reset inherited bold, then bold the labels
+        requests = [
+            {'insertText': {'location': {'index': start_index}, 'text': ''.join(parts)}},
+            {
+                'updateTextStyle': {
+                    'range': {'startIndex': start_index, 'endIndex': index},
+                    'textStyle': {'bold': False},
+                    'fields': 'bold'
+                }
+            },
+        ]
+        for start, end in bold_ranges:
+            requests.append({
+                'updateTextStyle': {
+                    'range': {'startIndex': start, 'endIndex': end},
+                    'textStyle': {'bold': True},
+                    'fields': 'bold'
+                }
+            })
         return requests
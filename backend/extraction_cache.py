@@ -0,0 +1,114 @@
+# backend/extraction_cache.py
+# Content-addressable on-disk cache for LLM extraction results.
+# Identical transcripts (re-uploads, retries) skip the Gemini round-trip.
+# The same class backs the opt-in AssemblyAI transcript cache (transcription.py).
+
+import hashlib
+import orjson
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from config import Config
+from logger import logger
+
+
+def make_key(provider: str, model: str, prompt_version: str, transcript: str) -> str:
+    """
+    Build the cache key for an extraction.
+    Any change of provider, model or prompt version yields a different key,
+    so stale results are never served after a prompt or model upgrade.
+    Each field is prefixed with its 8-byte length, so no two field tuples
+    hash the same bytes whatever characters they contain.
+    """
+    digest = hashlib.sha256()
+    for field in (provider, model, prompt_version, transcript):
+        data = field.encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Directory of <hexkey>.json files, sharded as ab/cd/abcd....json so no directory holds
+    more than a few hundred entries. Never raises — a cache failure must not block the pipeline.
+    Entries older than ttl_seconds are treated as misses and removed (ttl_seconds=0 keeps them forever).
+    Writes are atomic (temp file + rename); an unreadable entry is removed on first read.
+    """
+
+    def __init__(self, cache_dir: str, ttl_seconds: int = 0):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key[2:4], f"{key}.json")
+
+    def get(self, key: str) -> dict | None:
+        """Return the cached value for key, or None on miss."""
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = orjson.loads(f.read())
+            expires_at = entry.get('expires_at')
+            if expires_at and time.time() > expires_at:
+                logger.debug(f"Cache: expired {key[:12]}")
+                os.remove(self._path(key))
+                return None
+            logger.info(f"Cache: hit {key[:12]}")
+            return entry.get('value')
+        except FileNotFoundError:
+            return None
+        except orjson.JSONDecodeError as e:
+            # Corrupt entry — evict it so the next call recomputes and rewrites it
+            logger.warning(f"Cache: Evicting corrupt entry {key[:12]}: {e}")
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+        except Exception as e:
+            logger.warning(f"Cache: Could not read {key[:12]}: {e}")
+            return None
+
+    def delete(self, key: str):
+        """Remove the entry for key, if any."""
+        try:
+            os.remove(self._path(key))
+            logger.info(f"Cache: deleted {key[:12]}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Cache: Could not delete {key[:12]}: {e}")
+
+    def put(self, key: str, value: dict, **metadata):
+        """Store value under key, with UTC timestamp and caller metadata for auditing."""
+        try:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            entry = {
+                'key': key,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'expires_at': time.time() + self.ttl_seconds if self.ttl_seconds else None,
+                **metadata,
+                'value': value,
+            }
+            # orjson writes UTF-8 as-is (the ensure_ascii=False behaviour). The entry goes to a
+            # private temp file first, then is renamed into place — readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(orjson.dumps(entry))
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            logger.debug(f"Cache: stored {key[:12]}")
+        except Exception as e:
+            logger.warning(f"Cache: Could not store {key[:12]}: {e}")
+
+
+# Module-level instance — shared by all endpoints; None unless EXTRACTION_CACHE_DIR is set
+extraction_cache = (
+    ExtractionCache(Config.EXTRACTION_CACHE_DIR, Config.EXTRACTION_CACHE_TTL_SECONDS)
+    if Config.EXTRACTION_CACHE_DIR else None
+)
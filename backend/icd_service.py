@@ -4,12 +4,17 @@
 import re
 import requests
 import time
+from requests.adapters import HTTPAdapter
 from config import Config
 from logger import logger
 
 # Module-level token cache
 _token_cache = {'token': None, 'expires_at': 0}
 
+# Shared keep-alive session — every lookup reuses the TLS connection to WHO
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_maxsize=Config.PIPELINE_MAX_CONCURRENCY))
+
 TOKEN_ENDPOINT  = 'https://icdaccessmanagement.who.int/connect/token'
 SEARCH_ENDPOINT = 'https://id.who.int/icd/release/11/2026-01/mms/search'
 
@@ -25,7 +30,7 @@ def _get_token() -> str | None:
         return None
 
     try:
-        resp = requests.post(
+        resp = _session.post(
             TOKEN_ENDPOINT,
             data={
                 'grant_type': 'client_credentials',
@@ -64,7 +69,7 @@ def lookup_cie11(diagnosis_text: str) -> dict | None:
         return None
 
     try:
-        resp = requests.get(
+        resp = _session.get(
             SEARCH_ENDPOINT,
             params={'q': diagnosis_text, 'flatResults': 'true', 'highlightingEnabled': 'false'},
             headers={
@@ -2,74 +2,62 @@
 # added logic to prompt, line 41
 # import google.generativeai as genai
 from google import genai
-from google.genai import types # For configuration
+from google.genai import errors, types # For configuration
 from config import Config
-from logger import logger
+from logger import Preview, logger
 from icd_service import lookup_cie11
+from clinical_note import ClinicalNote
+from extraction_cache import make_key, extraction_cache
+from semantic_cache import semantic_cache
+import asyncio
+import contextvars
+import fastjsonschema
+import functools
+import hashlib
 import json
+import orjson
 import os
+import random
+import threading
 import time
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional
+from pydantic import ValidationError
 
-class LLMProcessor:
-    """Processes transcripts using Google Gemini for structured extraction"""
-    
-    def __init__(self):
-        """Initialize Gemini API"""
-# No bueno        genai.configure(api_key=Config.GEMINI_API_KEY)
-        
-        # Use Gemini flash-latest for fast, cost-effective processing
-        # self.model = genai.GenerativeModel('gemini-3-flash')
+# Bump whenever the extraction prompt changes — invalidates cached extractions
+PROMPT_VERSION = 'v3'
+PROVIDER = 'gemini'
 
-        self.client = genai.Client(api_key=Config.GEMINI_API_KEY)
-        self.model_id = 'gemini-2.5-flash'
-        
-        # Load JSON schema
-        # Look for the file in the current folder, wherever that may be
-        import os
-        base_dir = os.path.dirname(__file__)
-        schema_path = os.path.join(base_dir, 'schema.json')
-        with open(schema_path, 'r', encoding='utf-8') as f:
-            self.schema = json.load(f)
-    
-    def create_extraction_prompt(self, transcript: str, utterances: list = None, role_map: dict = None) -> str:
-        """
-        Create detailed prompt for Gemini to extract medical information
+# Prepended to the transcript when it carries speaker role labels
+SPEAKER_ROLES_NOTE = (
+    "El transcript está etiquetado con roles clínicos:\n"
+    "[Doctor]: intervenciones del médico — diagnósticos, indicaciones, preguntas clínicas\n"
+    "[Paciente]: lo que dice el paciente — síntomas, respuestas, historia\n"
+    "[Familiar]: comentarios del familiar o acompañante, si está presente\n"
+    "[Enfermera]: intervenciones de enfermería, si está presente\n\n"
+    "Extrae la información SOAP basándote en estos roles:\n"
+    "- Subjetivo: principalmente de [Paciente] y [Familiar]\n"
+    "- Objetivo: de [Doctor] al describir hallazgos de exploración\n"
+    "- Evaluación y Plan: de [Doctor]\n\n"
+)
 
-        Args:
-            transcript: Raw Spanish transcript from AssemblyAI
-            utterances: Optional speaker-labeled utterances from AssemblyAI
-            role_map: Optional dict mapping speaker labels to clinical role names
+PROMPT_TAIL = "\n\nAhora extrae la información de la transcripción y genera el JSON:"
+
+# Appended to the request (never to the shared prefix) after a malformed JSON reply
+JSON_RETRY_NOTE = "NOTA: Asegúrate de devolver SOLO JSON válido, sin texto adicional."
+
+# Replaces the middle of a transcript that exceeds Config.LLM_MAX_INPUT_TOKENS
+TRUNCATION_MARKER = "\n\n[...consulta larga: sección central omitida...]\n\n"
+# Gemini averages ~4 characters per token on Spanish text; below 2 chars/token
+# a transcript cannot exceed the budget, so count_tokens is skipped
+MIN_CHARS_PER_TOKEN = 2
 
-        Returns:
-            Formatted prompt for LLM
-        """
-        if utterances:
-            role_map = role_map or {}
-            def _role(u):
-                spk = u['speaker']
-                return role_map.get(spk, 'Hablante ' + spk)
-            transcript_content = "\n".join(
-                f"[{_role(u)}]: {u['text']}" for u in utterances
-            )
-            speaker_instruction = (
-                "\n6. El transcript está etiquetado con roles clínicos:\n"
-                "[Doctor]: intervenciones del médico — diagnósticos, indicaciones, preguntas clínicas\n"
-                "[Paciente]: lo que dice el paciente — síntomas, respuestas, historia\n"
-                "[Familiar]: comentarios del familiar o acompañante, si está presente\n"
-                "[Enfermera]: intervenciones de enfermería, si está presente\n\n"
-                "Extrae la información SOAP basándote en estos roles:\n"
-                "- Subjetivo: principalmente de [Paciente] y [Familiar]\n"
-                "- Objetivo: de [Doctor] al describir hallazgos de exploración\n"
-                "- Evaluación y Plan: de [Doctor]"
-            )
-        else:
-            transcript_content = transcript
-            speaker_instruction = ""
 
-        prompt = f"""Eres un asistente médico especializado en crear notas clínicas siguiendo el formato SOAP (Subjetivo, Objetivo, Evaluación, Plan).
+# Invariant part of the extraction prompt, sent as the system instruction so every
+# request shares the same prefix (Gemini prefix caching); only the transcript varies.
+SYSTEM_INSTRUCTION = """Eres un asistente médico especializado en crear notas clínicas siguiendo el formato SOAP (Subjetivo, Objetivo, Evaluación, Plan).
 
-Tu tarea es analizar la siguiente transcripción de una consulta médica en español y extraer toda la información relevante en un formato JSON estructurado.
+Tu tarea es analizar la transcripción de una consulta médica en español y extraer toda la información relevante en un formato JSON estructurado.
 
 INSTRUCCIONES CRÍTICAS:
 1. Debes extraer ÚNICAMENTE información que esté explícitamente mencionada en la transcripción
@@ -78,31 +66,28 @@ INSTRUCCIONES CRÍTICAS:
 4. Organiza la información según el formato SOAP
 5. Identifica y separa la información del paciente, síntomas, hallazgos, diagnóstico y plan de tratamiento
 6. Para peso y talla, escucha frases como 'el paciente pesa', 'la talla es', 'pesa X kilos', 'mide X'. Para habitus exterior, escucha frases como 'paciente consciente y orientado', 'bien orientado en tiempo y espacio', 'estado nutricional adecuado', 'paciente masculino/femenino, adulto'
-7. curp: NUNCA autogenerar ni inferir. Solo incluir si el médico lo menciona explícitamente durante la consulta.{speaker_instruction}
-
-TRANSCRIPCIÓN:
-{transcript_content}
+7. curp: NUNCA autogenerar ni inferir. Solo incluir si el médico lo menciona explícitamente durante la consulta.
 
 FORMATO DE SALIDA:
 Debes responder ÚNICAMENTE con un objeto JSON válido que siga este esquema:
 
-{{
-  "informacion_paciente": {{
+{
+  "informacion_paciente": {
     "nombre_del_paciente": "string (si se menciona)",
     "fecha_de_nacimiento": "string en formato DD/MM/YYYY (si se menciona)",
     "edad": "string (si se menciona)",
     "genero": "string (si se menciona)",
     "numero_expediente": "string - número de expediente si se menciona explícitamente; omitir si no se menciona",
     "curp": "string - CURP del paciente si se menciona explícitamente en la consulta; omitir si no se menciona. Nunca autogenerar."
-  }},
-  "subjetivo": {{
+  },
+  "subjetivo": {
     "motivo_de_consulta": "string - razón principal de la visita",
     "sintomas": ["lista de síntomas mencionados por el paciente"],
     "historia_de_enfermedad_actual": "string - descripción de cómo empezó y evolucionó",
     "duracion_sintomas": "string - hace cuánto empezaron los síntomas"
-  }},
-  "objetivo": {{
-    "signos_vitales": {{
+  },
+  "objetivo": {
+    "signos_vitales": {
       "presion_arterial": "string (si se menciona)",
       "frecuencia_cardiaca": "string (si se menciona)",
       "temperatura": "string (si se menciona)",
@@ -110,41 +95,41 @@ Debes responder ÚNICAMENTE con un objeto JSON válido que siga este esquema:
       "saturacion_oxigeno": "string (si se menciona)",
       "peso": "string en kg (si se menciona)",
       "talla": "string en cm o metros (si se menciona)"
-    }},
+    },
     "habitus_exterior": "string - descripción general del paciente: edad aparente, estado de consciencia, orientación, estado nutricional (si se menciona)",
     "examen_fisico": "string - hallazgos del examen físico",
     "hallazgos": ["lista de hallazgos objetivos"]
-  }},
-  "evaluacion": {{
+  },
+  "evaluacion": {
     "diagnostico": "string - diagnóstico principal",
     "diagnosticos_adicionales": ["otros diagnósticos o diagnósticos diferenciales"],
     "impresion_clinica": "string - impresión general del médico",
     "pronostico": "string - pronóstico esperado por el médico (favorable, reservado, o descripción)"
-  }},
-  "plan": {{
+  },
+  "plan": {
     "tratamiento": "string - plan de tratamiento general",
     "medicamentos": [
-      {{
+      {
         "nombre": "nombre del medicamento",
         "dosis": "dosis prescrita",
         "frecuencia": "con qué frecuencia tomar",
         "duracion": "por cuánto tiempo"
-      }}
+      }
     ],
     "recomendaciones": ["lista de recomendaciones e instrucciones"],
     "estudios_solicitados": ["laboratorios, imágenes u otros estudios solicitados"],
     "seguimiento": "string - instrucciones de seguimiento"
-  }},
-  "metadata": {{
+  },
+  "metadata": {
     "fecha_consulta": "string (si se menciona)",
     "medico": "string (si se menciona)",
     "duracion_consulta": "string (si se puede determinar)"
-  }},
-  "actualizacion_antecedentes": {{
+  },
+  "actualizacion_antecedentes": {
     "detectado": "true o false - detecta si el paciente menciona antecedentes hereditarios, familiares o personales nuevos no capturados previamente (por ejemplo, un diagnóstico reciente de un familiar)",
     "contenido": "string - descripción del antecedente nuevo mencionado (omitir si detectado es false)"
-  }}
-}}
+  }
+}
 
 REGLAS IMPORTANTES:
 - IMPORTANTE: Si necesitas citar al paciente o usar comillas dentro de un texto, usa SOLO comillas simples ('ejemplo'). NUNCA uses comillas dobles dentro de un valor de texto, ya que esto destruye el formato JSON.
@@ -154,84 +139,590 @@ REGLAS IMPORTANTES:
 - Asegúrate de que el JSON sea válido y pueda ser parseado
 # - Usa comillas dobles para strings, no comillas simples
 - Usa comillas dobles estrictamente para las llaves y estructura general del JSON.
-- Mantén los acentos y caracteres especiales del español
+- Mantén los acentos y caracteres especiales del español"""
+
+
+TRANSIENT_STATUS_CODES = {429, 500, 503, 504}
+# Transport-level failures that never reach an HTTP status (timeouts, dropped connections)
+TRANSIENT_ERROR_MARKERS = ("deadline", "cancelled", "timed out", "timeout", "connection reset")
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Server-suggested delay: a Retry-After header, else the RetryInfo detail Gemini sends with a 429."""
+    headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    details = getattr(e, 'details', None)
+    if isinstance(details, dict):
+        for detail in details.get('error', {}).get('details', []) or []:
+            delay = isinstance(detail, dict) and detail.get('retryDelay')
+            if isinstance(delay, str) and delay.endswith('s'):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return None
+
+
+class _RetryBudget:
+    """
+    Retry policy for one extraction. Two separate budgets:
+    - transient errors (rate limit, 5xx, timeouts): exponential backoff with jitter,
+      Config.LLM_TRANSIENT_RETRIES times, honoring the server's retry delay
+    - model errors (malformed JSON, empty reply): max_retries attempts in total
+    so a burst of 429s never uses up the attempts meant for a bad response.
+    """
+
+    def __init__(self, max_retries: int):
+        self.max_retries = max_retries
+        self.attempts = 0
+        self.transient = 0
+
+    @property
+    def calls(self) -> int:
+        return self.attempts + self.transient
+
+    def plan(self, e: Exception) -> Optional[tuple[float, str]]:
+        """
+        Record a failed call and decide whether to retry.
+        Returns (seconds to wait, retry note for the prompt — '' keeps the current one) or None to give up.
+        """
+        if self._is_transient(e) and self.transient < Config.LLM_TRANSIENT_RETRIES:
+            wait_time = _retry_after(e)
+            if wait_time is None:
+                wait_time = Config.LLM_BACKOFF_BASE_SECONDS * 2 ** self.transient + random.random()
+            wait_time = min(wait_time, Config.LLM_BACKOFF_MAX_SECONDS)
+            self.transient += 1
+            logger.warning(f"LLM: Server busy. Retrying in {wait_time:.1f}s...")
+            return wait_time, ''
+
+        self.attempts += 1
+        if self.attempts >= self.max_retries:
+            return None
+
+        # Malformed or off-schema JSON: retry once more with a note in the prompt
+        error_msg = str(e).lower()
+        # (orjson.JSONDecodeError subclasses json.JSONDecodeError)
+        if isinstance(e, (json.JSONDecodeError, ValidationError)) or "json" in error_msg or "expecting value" in error_msg:
+            logger.warning("LLM: JSON format error, retrying...")
+            return 0, JSON_RETRY_NOTE
+
+        # If it's a completely different error (like a 404), give up immediately
+        return None
+
+    @staticmethod
+    def _is_transient(e: Exception) -> bool:
+        if isinstance(e, errors.APIError):
+            return e.code in TRANSIENT_STATUS_CODES
+        error_msg = str(e).lower()
+        return any(x in error_msg for x in TRANSIENT_ERROR_MARKERS)
 
-Ahora extrae la información de la transcripción y genera el JSON:"""
+
+@functools.lru_cache(maxsize=1)
+def load_schema() -> Dict:
+    """Load schema.json — look for the file next to this module, wherever that may be."""
+    schema_path = os.path.join(os.path.dirname(__file__), 'schema.json')
+    with open(schema_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+@functools.lru_cache(maxsize=1)
+def schema_validator():
+    """schema.json compiled to a Python function — built once, then O(data) per call."""
+    return fastjsonschema.compile(load_schema())
+
+
+# Recent token counts keyed by (model, SHA-256 of the text) — never by the
+# transcript itself, so no patient text outlives its request here
+TOKEN_COUNT_CACHE_SIZE = 32
+_token_counts: 'OrderedDict[tuple, int]' = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def _count_tokens(client: genai.Client, model_id: str, text: str) -> int:
+    """Gemini token count — cached, so retries of the same transcript don't recount."""
+    key = (model_id, hashlib.sha256(text.encode('utf-8')).hexdigest())
+    with _token_counts_lock:
+        if key in _token_counts:
+            _token_counts.move_to_end(key)
+            return _token_counts[key]
+    tokens = client.models.count_tokens(model=model_id, contents=text).total_tokens
+    with _token_counts_lock:
+        _token_counts[key] = tokens
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return tokens
+
+
+# Async Gemini client of the running extract_many batch (None outside a batch)
+_batch_aio_client = contextvars.ContextVar('_batch_aio_client', default=None)
+
+
+def _cache_lookup(processor, key: str, content: str) -> Optional[Dict]:
+    """Exact tier, then semantic tier. Entries are re-validated; invalid ones are ignored."""
+    for tier, cached in (('exact', lambda: extraction_cache.get(key) if extraction_cache else None),
+                         ('semantic', lambda: semantic_cache.get(content))):
+        structured_data = cached()
+        if structured_data is None:
+            continue
+        is_valid, error_msg = processor.validate_against_schema(structured_data)
+        if is_valid:
+            logger.info(f"LLM: Served from {tier} extraction cache")
+            return structured_data
+        logger.warning(f"LLM: Ignoring invalid {tier} cache entry: {error_msg}")
+    return None
+
+
+def _cache_store(processor, key: str, content: str, structured_data: Dict):
+    """Store a valid extraction in both tiers."""
+    if processor.validate_against_schema(structured_data)[0]:
+        if extraction_cache:
+            extraction_cache.put(
+                key, structured_data,
+                provider=PROVIDER, model=processor.model_id, prompt_version=PROMPT_VERSION,
+            )
+        semantic_cache.put(content, structured_data)
+
+
+def cached_extraction(extract):
+    """
+    Two-tier cache around extract_structured_data (sync or async):
+    1. exact hit on the content-addressed disk cache
+    2. near-duplicate hit on the semantic (embedding) cache, when enabled
+    Cached values are re-validated on recall; only valid extractions are stored.
+    use_cache=False bypasses both tiers (lookup and store), e.g. to force a fresh extraction.
+    """
+    if asyncio.iscoroutinefunction(extract):
+        @functools.wraps(extract)
+        async def async_wrapper(self, transcript: str, utterances: list = None, role_map: dict = None,
+                                max_retries: int = 3, use_cache: bool = True) -> Dict:
+            if not use_cache:
+                return await extract(self, transcript, utterances, role_map, max_retries)
+
+            key = self.cache_key(transcript, utterances, role_map)
+            content = self._transcript_content(transcript, utterances, role_map)
+            # Disk reads and embeddings block — keep them off the event loop
+            structured_data = await asyncio.to_thread(_cache_lookup, self, key, content)
+            if structured_data is not None:
+                return structured_data
+
+            structured_data = await extract(self, transcript, utterances, role_map, max_retries)
+            await asyncio.to_thread(_cache_store, self, key, content, structured_data)
+            return structured_data
+
+        return async_wrapper
+
+    @functools.wraps(extract)
+    def wrapper(self, transcript: str, utterances: list = None, role_map: dict = None, max_retries: int = 3,
+                use_cache: bool = True) -> Dict:
+        if not use_cache:
+            return extract(self, transcript, utterances, role_map, max_retries)
+
+        key = self.cache_key(transcript, utterances, role_map)
+        content = self._transcript_content(transcript, utterances, role_map)
+        structured_data = _cache_lookup(self, key, content)
+        if structured_data is not None:
+            return structured_data
+
+        structured_data = extract(self, transcript, utterances, role_map, max_retries)
+        _cache_store(self, key, content, structured_data)
+        return structured_data
+
+    return wrapper
+
+
+class LLMProcessor:
+    """Processes transcripts using Google Gemini for structured extraction"""
+
+    # Static for the life of the process — built once, shared by every call
+    # (the SDK only reads the config, so one instance is safe across threads)
+    _GEN_CONFIG = types.GenerateContentConfig(
+        temperature=0.1,
+        max_output_tokens=Config.LLM_MAX_OUTPUT_TOKENS,
+        response_mime_type='application/json',
+        response_schema=ClinicalNote,
+        system_instruction=SYSTEM_INSTRUCTION,
+    )
+    
+    def __init__(self):
+        """Initialize Gemini API"""
+# No bueno        genai.configure(api_key=Config.GEMINI_API_KEY)
         
-        return prompt
+        # Use Gemini flash-latest for fast, cost-effective processing
+        # self.model = genai.GenerativeModel('gemini-3-flash')
+
+        # The Gemini client and the JSON schema are created on first use (see client / schema),
+        # so importing this module or serving a cache hit costs no SDK setup or disk read
+        self.model_id = 'gemini-2.5-flash'
+
+        # Explicit Gemini context cache holding SYSTEM_INSTRUCTION (see _generation_config)
+        self._context_cache_name = None
+        self._context_cache_expires = 0.0
+        self._context_cache_lock = threading.Lock()
+        self._cached_gen_config = None
+
+    @functools.cached_property
+    def client(self) -> genai.Client:
+        """Gemini client, built on first call to the API."""
+        return genai.Client(api_key=Config.GEMINI_API_KEY)
+
+    @property
+    def schema(self) -> Dict:
+        """schema.json, read once per process."""
+        return load_schema()
+
+    def _context_cache(self) -> Optional[str]:
+        """
+        Name of the explicit Gemini cache holding SYSTEM_INSTRUCTION, created on first
+        use and recreated shortly before its TTL runs out. None when disabled or when
+        creation failed (then not retried until the TTL window has passed).
+        """
+        if not Config.GEMINI_CONTEXT_CACHE_ENABLED:
+            return None
+        with self._context_cache_lock:
+            if time.monotonic() < self._context_cache_expires:
+                return self._context_cache_name
+            ttl = Config.GEMINI_CONTEXT_CACHE_TTL_SECONDS
+            try:
+                cache = self.client.caches.create(
+                    model=self.model_id,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=SYSTEM_INSTRUCTION,
+                        display_name=f"clinia-soap-{PROMPT_VERSION}",
+                        ttl=f"{ttl}s",
+                    )
+                )
+                self._context_cache_name = cache.name
+                logger.info(f"LLM: Created context cache {cache.name}")
+            except Exception as e:
+                self._context_cache_name = None
+                logger.warning(f"LLM: Context cache unavailable, sending system instruction inline: {e}")
+            # Refresh a minute early so a request never references an expired cache
+            self._context_cache_expires = time.monotonic() + max(ttl - 60, 60)
+            return self._context_cache_name
+
+    def _generation_config(self) -> types.GenerateContentConfig:
+        """Generation config — the system instruction comes from the context cache when one is available."""
+        cached_content = self._context_cache()
+        if not cached_content:
+            return self._GEN_CONFIG
+        if self._cached_gen_config is None or self._cached_gen_config.cached_content != cached_content:
+            self._cached_gen_config = self._GEN_CONFIG.model_copy(
+                update={'system_instruction': None, 'cached_content': cached_content}
+            )
+        return self._cached_gen_config
+
+    def _transcript_content(self, transcript: str, utterances: list = None, role_map: dict = None) -> str:
+        """Transcript as it appears in the prompt — role-labeled when utterances are available."""
+        if not utterances:
+            return transcript
+        role_map = role_map or {}
+        def _role(u):
+            spk = u['speaker']
+            return role_map.get(spk, 'Hablante ' + spk)
+        return "\n".join(f"[{_role(u)}]: {u['text']}" for u in utterances)
+
+    def cache_key(self, transcript: str, utterances: list = None, role_map: dict = None) -> str:
+        """Extraction cache key — covers model, prompt version and the exact transcript sent to Gemini."""
+        return make_key(
+            PROVIDER, self.model_id, PROMPT_VERSION,
+            self._transcript_content(transcript, utterances, role_map)
+        )
+
+    def forget_extraction(self, transcript_content: str):
+        """
+        Evict the cached extraction for a transcript as it appeared in the prompt
+        (role-labeled text when there were utterances) from both tiers — used on
+        ARCO cancellation. The semantic tier also drops near-duplicates.
+        """
+        if extraction_cache:
+            extraction_cache.delete(make_key(PROVIDER, self.model_id, PROMPT_VERSION, transcript_content))
+        semantic_cache.delete(transcript_content)
+
+    def create_extraction_prompt(self, transcript: str, utterances: list = None, role_map: dict = None,
+                                 retry_note: str = '') -> str:
+        """
+        Create the per-request part of the Gemini prompt (SYSTEM_INSTRUCTION is the fixed prefix)
+
+        Args:
+            transcript: Raw Spanish transcript from AssemblyAI
+            utterances: Optional speaker-labeled utterances from AssemblyAI
+            role_map: Optional dict mapping speaker labels to clinical role names
+            retry_note: Optional feedback appended last on a retry
+
+        Returns:
+            Formatted prompt for LLM
+        """
+        transcript_content = self._fit_transcript(self._transcript_content(transcript, utterances, role_map))
+        speaker_instruction = SPEAKER_ROLES_NOTE if utterances else ""
+
+        return self._build_suffix(transcript_content, speaker_instruction, retry_note)
+
+    def _fit_transcript(self, transcript_content: str) -> str:
+        """
+        Keep the transcript within Config.LLM_MAX_INPUT_TOKENS: when over budget, keep
+        the first 60% and last 30% of the budget (history and plan usually live at the
+        ends of a consultation) and replace the middle with TRUNCATION_MARKER.
+        """
+        max_tokens = Config.LLM_MAX_INPUT_TOKENS
+        if not max_tokens or len(transcript_content) <= max_tokens * MIN_CHARS_PER_TOKEN:
+            return transcript_content
+        try:
+            tokens = _count_tokens(self.client, self.model_id, transcript_content)
+        except Exception as e:
+            logger.warning(f"LLM: count_tokens failed, estimating from length: {e}")
+            tokens = len(transcript_content) // 4
+        if tokens <= max_tokens:
+            return transcript_content
+
+        # Budget in characters, then snap both cuts to line (utterance) boundaries
+        keep = len(transcript_content) * max_tokens / tokens
+        head_end = transcript_content.rfind('\n', 0, int(keep * 0.6))
+        if head_end <= 0:
+            head_end = int(keep * 0.6)
+        tail_start = transcript_content.find('\n', len(transcript_content) - int(keep * 0.3))
+        if tail_start < 0:
+            tail_start = len(transcript_content) - int(keep * 0.3)
+        logger.warning(f"LLM: Transcript has {tokens} tokens (limit {max_tokens}) — middle section omitted")
+        return (transcript_content[:head_end] + TRUNCATION_MARKER
+                + transcript_content[tail_start:].lstrip('\n'))
+
+    @staticmethod
+    def _build_suffix(transcript_content: str, speaker_instruction: str = '', retry_note: str = '') -> str:
+        """
+        Variable tail of the request: role note, transcript, then retry feedback.
+        Everything before it stays byte-identical across calls and retries, so
+        Gemini can reuse the cached prefix.
+        """
+        prompt = speaker_instruction + "TRANSCRIPCIÓN:\n" + transcript_content + PROMPT_TAIL
+        return LLMProcessor._with_retry_note(prompt, retry_note)
+
+    @staticmethod
+    def _with_retry_note(prompt: str, retry_note: str) -> str:
+        """prompt plus the (single) retry note — the base prompt itself is never modified."""
+        return f"{prompt}\n\n{retry_note}" if retry_note else prompt
     
+    @cached_extraction
     def extract_structured_data(self, transcript: str, utterances: list = None, role_map: dict = None, max_retries: int = 3) -> Dict:
         """
         Extract structured medical data from transcript using Gemini
         """
+        stub = self._too_short(transcript)
+        if stub:
+            return stub
+
         logger.info(f"LLM: Processing with {self.model_id}...")
         if utterances:
             logger.info(f"LLM: Using {len(utterances)} speaker-labeled utterances")
-        prompt = self.create_extraction_prompt(transcript, utterances, role_map)
+        retry_note = ''
         
         last_error = "Unknown error"
         
-        for attempt in range(max_retries):
+        budget = _RetryBudget(max_retries)
+
+        # Built once; retries only swap the note appended after it
+        base_prompt = self.create_extraction_prompt(transcript, utterances, role_map)
+
+        while True:
             try:
+                prompt = self._with_retry_note(base_prompt, retry_note)
                 response = self.client.models.generate_content(
                     model=self.model_id,
                     contents=prompt,
-                    config=types.GenerateContentConfig(
-                        temperature=0.1,
-                        response_mime_type='application/json',
-                    )
+                    config=self._generation_config()
                 )
-                
-                if not response.text:
-                    raise ValueError("Empty response from Google API")
-                    
-                logger.debug(f"LLM: Raw response received. Length: {len(response.text)}")
+                structured_data = self._parse_response(response.text)
+                self._inject_cie11(structured_data)
+                return structured_data
 
-                # Clean the text JUST IN CASE Gemini added markdown backticks
-                cleaned_text = self._clean_json_response(response.text)
+            except Exception as e:
+                last_error = str(e)
+                logger.error(f"LLM: Attempt {budget.calls + 1} failed: {last_error}")
+                retry = budget.plan(e)
+                if retry is None:
+                    break
+                wait_time, note = retry
+                retry_note = note or retry_note
+                time.sleep(wait_time)
 
-                structured_data = json.loads(cleaned_text)
-                logger.info("LLM: Extraction successful.")
+        return self._failure(last_error, transcript)
 
-                # CIE-11 lookup — inject code from WHO API based on Gemini's extracted diagnosis
-                try:
-                    diagnostico = structured_data.get('evaluacion', {}).get('diagnostico', '')
-                    if diagnostico:
-                        cie_result = lookup_cie11(diagnostico)
-                        if cie_result:
-                            structured_data.setdefault('evaluacion', {})
-                            structured_data['evaluacion']['codigo_cie11'] = cie_result['code']
-                            structured_data['evaluacion']['titulo_cie11'] = cie_result['title']
-                            logger.info(f"ICD: Injected CIE-11 code {cie_result['code']} into structured_data")
-                except Exception as e:
-                    logger.warning(f"ICD: Could not inject CIE-11 code (non-fatal): {e}")
+    @cached_extraction
+    async def extract_structured_data_async(self, transcript: str, utterances: list = None, role_map: dict = None, max_retries: int = 3) -> Dict:
+        """
+        Async twin of extract_structured_data. Calls go through the shared, pooled
+        sync client in a worker thread: Flask gives every async view a fresh event
+        loop, so a loop-bound async client could not reuse connections across
+        requests. Inside extract_many the batch's own async client is used instead.
+        """
+        stub = self._too_short(transcript)
+        if stub:
+            return stub
 
+        logger.info(f"LLM: Processing with {self.model_id} (async)...")
+        if utterances:
+            logger.info(f"LLM: Using {len(utterances)} speaker-labeled utterances")
+        retry_note = ''
+
+        last_error = "Unknown error"
+
+        budget = _RetryBudget(max_retries)
+
+        # Built once, off the event loop (count_tokens blocks for long transcripts);
+        # retries only swap the note appended after it
+        base_prompt = await asyncio.to_thread(self.create_extraction_prompt, transcript, utterances, role_map)
+
+        while True:
+            try:
+                prompt = self._with_retry_note(base_prompt, retry_note)
+                # Creating/refreshing the context cache is a blocking call
+                config = (await asyncio.to_thread(self._generation_config)
+                          if Config.GEMINI_CONTEXT_CACHE_ENABLED else self._generation_config())
+                batch_client = _batch_aio_client.get()
+                if batch_client is not None:
+                    response = await batch_client.models.generate_content(
+                        model=self.model_id,
+                        contents=prompt,
+                        config=config
+                    )
+                else:
+                    response = await asyncio.to_thread(
+                        self.client.models.generate_content,
+                        model=self.model_id,
+                        contents=prompt,
+                        config=config
+                    )
+                structured_data = self._parse_response(response.text)
+                # The WHO ICD API client is blocking
+                await asyncio.to_thread(self._inject_cie11, structured_data)
                 return structured_data
 
             except Exception as e:
                 last_error = str(e)
-                error_msg = str(e).lower()
-                logger.error(f"LLM: Attempt {attempt + 1} failed: {last_error}")
-
-                # Catch rate limits and server timeouts
-                if any(x in error_msg for x in ["429", "504", "deadline", "cancelled", "quota", "503"]):
-                    if attempt < max_retries - 1:
-                        wait_time = 5 * (attempt + 1)
-                        logger.warning(f"LLM: Server busy. Retrying in {wait_time}s...")
-                        time.sleep(wait_time)
-                        continue
-
-                # Catch JSON formatting errors and tell the prompt to be more careful
-                if "json" in error_msg or "expecting value" in error_msg:
-                    if attempt < max_retries - 1:
-                         prompt += "\n\nNOTA: Asegúrate de devolver SOLO JSON válido, sin texto adicional."
-                         logger.warning("LLM: JSON format error, retrying...")
-                         time.sleep(2)
-                         continue
-
-                # If it's a completely different error (like a 404), break immediately
-                break
+                logger.error(f"LLM: Attempt {budget.calls + 1} failed: {last_error}")
+                retry = budget.plan(e)
+                if retry is None:
+                    break
+                wait_time, note = retry
+                retry_note = note or retry_note
+                await asyncio.sleep(wait_time)
+
+        return self._failure(last_error, transcript)
+
+    def extract_structured_data_stream(self, transcript: str, utterances: list = None, role_map: dict = None) -> Iterator[tuple[str, object]]:
+        """
+        Streaming variant for the web layer. Yields ('chunk', text) as Gemini generates
+        the JSON, then exactly one ('result', structured_data) once it is parsed,
+        CIE-11-tagged and cached. A cache hit yields the result straight away.
+        If the stream fails, falls back to extract_structured_data (with its retries, result
+        cached as usual); any chunks already sent are superseded by the result.
+        """
+        stub = self._too_short(transcript)
+        if stub:
+            yield 'result', stub
+            return
+
+        key = self.cache_key(transcript, utterances, role_map)
+        content = self._transcript_content(transcript, utterances, role_map)
+        cached = _cache_lookup(self, key, content)
+        if cached is not None:
+            yield 'result', cached
+            return
+
+        logger.info(f"LLM: Streaming with {self.model_id}...")
+        buffer = []
+        try:
+            stream = self.client.models.generate_content_stream(
+                model=self.model_id,
+                contents=self.create_extraction_prompt(transcript, utterances, role_map),
+                config=self._generation_config()
+            )
+            for chunk in stream:
+                if chunk.text:
+                    buffer.append(chunk.text)
+                    yield 'chunk', chunk.text
+            structured_data = self._parse_response(''.join(buffer))
+        except Exception as e:
+            logger.warning(f"LLM: Streaming failed, retrying without streaming: {e}")
+            # Undecorated call — the lookup above already missed; the result is stored here
+            structured_data = LLMProcessor.extract_structured_data.__wrapped__(self, transcript, utterances, role_map)
+            _cache_store(self, key, content, structured_data)
+            yield 'result', structured_data
+            return
+
+        self._inject_cie11(structured_data)
+        _cache_store(self, key, content, structured_data)
+        yield 'result', structured_data
+
+    async def extract_many(self, transcripts: list, max_retries: int = 3) -> list:
+        """
+        Extract several transcripts concurrently, at most Config.LLM_MAX_CONCURRENCY
+        Gemini calls in flight. Results are returned in input order.
+        The batch runs on one loop, so it shares a single async client (client.aio).
+        google-genai 1.20 has no public close(): the client is released when the
+        batch ends and it goes out of scope.
+        """
+        semaphore = asyncio.Semaphore(Config.LLM_MAX_CONCURRENCY)
+
+        async def extract_one(transcript: str) -> Dict:
+            async with semaphore:
+                return await self.extract_structured_data_async(transcript, max_retries=max_retries)
 
+        batch_client = genai.Client(api_key=Config.GEMINI_API_KEY)
+        token = _batch_aio_client.set(batch_client.aio)
+        try:
+            return await asyncio.gather(*(extract_one(t) for t in transcripts))
+        finally:
+            _batch_aio_client.reset(token)
+
+    def _parse_response(self, text: Optional[str]) -> Dict:
+        """
+        Gemini reply text -> dict, validated against ClinicalNote (fields the model left
+        null are dropped). Raises ValueError / ValidationError for the retry loop.
+        """
+        if not text:
+            raise ValueError("Empty response from Google API")
+
+        logger.debug("LLM: Raw response (%d chars):\n%s", len(text), Preview(text))
+
+        # response_schema makes the reply valid JSON; the cleanup is a cheap safety net
+        cleaned_text = self._clean_json_response(text)
+
+        structured_data = ClinicalNote.model_validate_json(cleaned_text).model_dump(exclude_none=True)
+        logger.info("LLM: Extraction successful.")
+        return structured_data
+
+    def _inject_cie11(self, structured_data: Dict):
+        """CIE-11 lookup — inject code from WHO API based on Gemini's extracted diagnosis"""
+        try:
+            diagnostico = structured_data.get('evaluacion', {}).get('diagnostico', '')
+            if diagnostico:
+                cie_result = lookup_cie11(diagnostico)
+                if cie_result:
+                    structured_data.setdefault('evaluacion', {})
+                    structured_data['evaluacion']['codigo_cie11'] = cie_result['code']
+                    structured_data['evaluacion']['titulo_cie11'] = cie_result['title']
+                    logger.info(f"ICD: Injected CIE-11 code {cie_result['code']} into structured_data")
+        except Exception as e:
+            logger.warning(f"ICD: Could not inject CIE-11 code (non-fatal): {e}")
+
+    def _too_short(self, transcript: str) -> Optional[Dict]:
+        """Stub result, without a Gemini call, for a transcript too short to hold a consultation."""
+        length = len(transcript.strip()) if transcript else 0
+        if length >= Config.MIN_TRANSCRIPT_CHARS:
+            return None
+        logger.warning(f"LLM: Transcript has {length} characters — skipping extraction")
+        return {
+            "error": "Transcript too short for extraction",
+            "informacion_paciente": {},
+            "raw_transcript_length": length
+        }
+
+    def _failure(self, last_error: str, transcript: str) -> Dict:
+        """Error payload returned when every attempt failed."""
         # Fallback: We now include "last_error" so you can see it in the UI/Logs!
         logger.error(f"LLM: All attempts failed. Final error: {last_error}")
         return {
@@ -242,19 +733,38 @@ Ahora extrae la información de la transcripción y genera el JSON:"""
 
     def _clean_json_response(self, response: str) -> str:
         """
-        Clean LLM response to extract pure JSON
+        Clean LLM response to extract pure JSON: the first balanced {...} object.
+        Fences, leading prose and trailing text (even text containing braces) are dropped.
         """
-        # Remove any leading/trailing whitespace
         response = response.strip()
-        
-        # Remove any text before first { or after last }
-        first_brace = response.find('{')
-        last_brace = response.rfind('}')
-        
-        if first_brace != -1 and last_brace != -1:
-            response = response[first_brace:last_brace + 1]
-        
-        return response
+
+        start = response.find('{')
+        if start == -1:
+            return response
+
+        # Single pass tracking brace depth; braces inside JSON strings don't count
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(response)):
+            c = response[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == '\\':
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    return response[start:i + 1]
+
+        return response[start:]
     
     def validate_against_schema(self, data: Dict) -> tuple[bool, Optional[str]]:
         """
@@ -266,9 +776,11 @@ Ahora extrae la información de la transcripción y genera el JSON:"""
         Returns:
             Tuple of (is_valid, error_message)
         """
-        # Basic validation - check required fields
-        if "informacion_paciente" not in data:
-            return False, "Missing required field: informacion_paciente"
+        # Structural validation (types, required informacion_paciente) against schema.json
+        try:
+            schema_validator()(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return False, e.message
         
         # Check that at least some meaningful data was extracted
         has_content = False
@@ -284,6 +796,21 @@ Ahora extrae la información de la transcripción y genera el JSON:"""
 
 
 
+# Shared instance — one Gemini client (and its connection pool) per process
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_processor() -> LLMProcessor:
+    """Return the shared LLMProcessor, creating it on first use."""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = LLMProcessor()
+    return _processor
+
+
 # Testing
 if __name__ == "__main__":
     Config.validate()
@@ -305,7 +832,7 @@ if __name__ == "__main__":
     Doctor: Sí, descanse, tome muchos líquidos y regrese en una semana si no mejora.
     """
     
-    processor = LLMProcessor()
+    processor = get_processor()
     result = processor.extract_structured_data(sample_transcript)
     
-    logger.info("EXTRACTED STRUCTURED DATA:\n" + json.dumps(result, indent=2, ensure_ascii=False))
+    logger.info("EXTRACTED STRUCTURED DATA:\n%s", orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode())
@@ -2,15 +2,38 @@
 # Centralized logging configuration for ClinIA
 # Replaces all print() statements across the backend
 
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
 import sys
 
 
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the record unformatted: the stdlib prepare() runs
+    self.format() (%-interpolation, Preview truncation) on the emitting thread.
+    Only exc_info is rendered here, since the traceback cannot cross the queue;
+    the listener's handlers do the actual formatting.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
 def setup_logger(name: str = 'clinia') -> logging.Logger:
     """
     Configure and return the ClinIA application logger.
     Outputs to stdout so Render captures logs correctly.
     Format: [LEVEL] [MODULE] message
+
+    Request threads only enqueue records, unformatted (_DeferredQueueHandler);
+    a background QueueListener formats them and does the stdout write.
+    Level comes from LOG_LEVEL (default DEBUG); below it, guarded debug blocks are skipped.
     """
     logger = logging.getLogger(name)
 
@@ -18,7 +41,7 @@ def setup_logger(name: str = 'clinia') -> logging.Logger:
     if logger.handlers:
         return logger
 
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(os.getenv('LOG_LEVEL', 'DEBUG').upper())
 
     # Console handler — stdout for Render compatibility
     handler = logging.StreamHandler(sys.stdout)
@@ -29,7 +52,13 @@ def setup_logger(name: str = 'clinia') -> logging.Logger:
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(listener.stop)
 
     # Prevent propagation to root logger to avoid duplicate output
     logger.propagate = False
@@ -37,5 +66,23 @@ def setup_logger(name: str = 'clinia') -> logging.Logger:
     return logger
 
 
+class Preview:
+    """
+    Log argument that truncates text only when the record is formatted:
+    logger.debug("Raw: %s", Preview(text)) builds no slice if DEBUG is off.
+    """
+
+    __slots__ = ('text', 'limit')
+
+    def __init__(self, text: str, limit: int = 500):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self) -> str:
+        if len(self.text) <= self.limit:
+            return self.text
+        return self.text[:self.limit] + '...'
+
+
 # Module-level logger instance — import this in all backend files
 logger = setup_logger('clinia')
@@ -0,0 +1,137 @@
+# backend/semantic_cache.py
+# Second-tier LLM extraction cache: cosine similarity over sentence embeddings.
+# Catches lightly edited / re-punctuated transcripts that miss the exact-hash tier.
+#
+# Optional: requires `sentence-transformers` (pulls in torch, so it is not in
+# requirements.txt). When the package is missing the cache disables itself.
+
+import copy
+import threading
+import time
+from config import Config
+from logger import logger
+
+
+class SemanticCache:
+    """
+    In-memory (embedding, structured_data) index searched with a single dot product.
+    Bounded: at most max_entries rows, each evicted after ttl_seconds (oldest first),
+    so a long-running worker's memory stays flat.
+    """
+
+    def __init__(self, model_name: str, threshold: float, enabled: bool = True,
+                 max_entries: int = 2048, ttl_seconds: int = 24 * 3600):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._encoder = None
+        self._np = None
+        self._index = None       # (N, dim) matrix of L2-normalized embeddings
+        self._values = []        # structured_data dicts, aligned with _index rows
+        self._created = []       # monotonic insert times, aligned with _index rows
+        self._lock = threading.Lock()
+
+    def _load_encoder(self) -> bool:
+        """Import numpy + sentence-transformers on first use. Returns False if unavailable."""
+        if self._encoder is not None:
+            return True
+        try:
+            import numpy as np
+            from sentence_transformers import SentenceTransformer
+            self._np = np
+            self._encoder = SentenceTransformer(self.model_name)
+            logger.info(f"SemanticCache: Loaded {self.model_name}")
+            return True
+        except Exception as e:
+            logger.warning(f"SemanticCache: Disabled — could not load {self.model_name}: {e}")
+            self.enabled = False
+            return False
+
+    def _evict(self, keep_free: int = 0):
+        """Drop expired rows and the oldest rows beyond capacity. Caller holds the lock."""
+        cutoff = time.monotonic() - self.ttl_seconds
+        drop = 0
+        while drop < len(self._created) and self._created[drop] < cutoff:
+            drop += 1
+        drop = max(drop, len(self._created) + keep_free - self.max_entries)
+        if drop <= 0:
+            return
+        del self._values[:drop]
+        del self._created[:drop]
+        self._index = self._index[drop:] if self._values else None
+
+    def _embed(self, text: str):
+        return self._encoder.encode(text, normalize_embeddings=True)
+
+    def get(self, text: str) -> dict | None:
+        """Return the closest cached value if its cosine similarity clears the threshold."""
+        if not self.enabled or self._index is None or not self._load_encoder():
+            return None
+        try:
+            query = self._embed(text)
+            with self._lock:
+                self._evict()
+                if self._index is None:
+                    return None
+                scores = self._np.dot(self._index, query)
+                best = int(scores.argmax())
+                score = float(scores[best])
+                value = self._values[best]
+            if score < self.threshold:
+                return None
+            logger.info(f"SemanticCache: hit (cos={score:.3f})")
+            # Callers mutate the result (metadata injection) — never hand out the cached object
+            return copy.deepcopy(value)
+        except Exception as e:
+            logger.warning(f"SemanticCache: Lookup failed: {e}")
+            return None
+
+    def put(self, text: str, value: dict):
+        """Add a (text embedding, value) pair to the index."""
+        if not self.enabled or not self._load_encoder():
+            return
+        try:
+            vector = self._embed(text)
+            with self._lock:
+                self._evict(keep_free=1)
+                row = vector.reshape(1, -1)
+                self._index = row if self._index is None else self._np.vstack([self._index, row])
+                self._values.append(copy.deepcopy(value))
+                self._created.append(time.monotonic())
+        except Exception as e:
+            logger.warning(f"SemanticCache: Could not store entry: {e}")
+
+    def delete(self, text: str) -> int:
+        """
+        Drop every entry a lookup of text could return (cosine >= threshold) — used on
+        ARCO cancellation, so near-duplicates of the transcript are evicted too.
+        Returns the number of entries removed.
+        """
+        if not self.enabled or self._index is None or not self._load_encoder():
+            return 0
+        query = self._embed(text)
+        with self._lock:
+            if self._index is None:
+                return 0
+            keep = self._np.dot(self._index, query) < self.threshold
+            removed = len(self._values) - int(keep.sum())
+            if removed:
+                self._values = [v for v, k in zip(self._values, keep) if k]
+                self._created = [t for t, k in zip(self._created, keep) if k]
+                self._index = self._index[keep] if self._values else None
+        if removed:
+            logger.info(f"SemanticCache: Deleted {removed} entr{'y' if removed == 1 else 'ies'}")
+        return removed
+
+
+# Module-level instance — off by default: a near-duplicate transcript from a
+# different consultation must never return someone else's note.
+semantic_cache = SemanticCache(
+    Config.SEMANTIC_CACHE_MODEL,
+    Config.SEMANTIC_CACHE_THRESHOLD,
+    enabled=Config.SEMANTIC_CACHE_ENABLED,
+    max_entries=Config.SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl_seconds=Config.SEMANTIC_CACHE_TTL_SECONDS,
+)
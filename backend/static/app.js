@@ -30,6 +30,10 @@ const state = {
 // API Configuration
 const API_BASE_URL = window.location.origin.replace(/\/$/, '');
 
+// Webhook mode: /api/process-audio answers 202 and the note is polled for
+const SESSION_POLL_INTERVAL_MS = 3000;
+const SESSION_POLL_TIMEOUT_MS = 30 * 60 * 1000; // long consultations can take a while
+
 // ─────────────────────────────────────────────
 // Doctor email persistence (localStorage)
 // ─────────────────────────────────────────────
@@ -507,15 +511,19 @@ async function processAudio() {
         }
 
         updateProgress(30, 'Transcribiendo audio...', 1);
-        await sleep(1000);
+
+        // Get results — a 202 means the server finishes in the background (webhook mode)
+        let result = await response.json();
+        if (response.status === 202) {
+            result = await waitForSession(result.session_id);
+        } else {
+            await sleep(1000);
+        }
 
         updateProgress(70, 'Extrayendo información médica...', 2);
         await sleep(1000);
 
         updateProgress(100, 'Listo para revisión.', 2);
-
-        // Get results
-        const result = await response.json();
         console.log('[ClinIA] Processing completed:', result);
 
         // Store session
@@ -1158,6 +1166,27 @@ function sleep(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
 }
 
+async function waitForSession(sessionId) {
+    // Poll until the background transcription + extraction leaves the session
+    // in pending_review (or failed)
+    const deadline = Date.now() + SESSION_POLL_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+        await sleep(SESSION_POLL_INTERVAL_MS);
+        const response = await fetch(`${API_BASE_URL}/api/session/${encodeURIComponent(sessionId)}`);
+        if (!response.ok) {
+            throw new Error('No se pudo consultar el estado de la sesión');
+        }
+        const session = await response.json();
+        if (session.status === 'pending_review') {
+            return session;
+        }
+        if (session.status === 'failed') {
+            throw new Error(session.error || 'Error en el procesamiento');
+        }
+    }
+    throw new Error('Tiempo de espera agotado al procesar el audio');
+}
+
 // ─────────────────────────────────────────────
 // Aviso de Privacidad modal
 // ─────────────────────────────────────────────
@@ -1,12 +1,20 @@
 # backend/transcription.py
 # Added custom spelling section line 37
+import asyncio
+import functools
+import hashlib
+import io
+import logging
+import threading
 import assemblyai as aai
 from config import Config
+from extraction_cache import ExtractionCache, make_key
 from logger import logger
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Union
 
 
-def assign_speaker_roles(utterances: list, speakers_expected: int) -> dict:
+def roles_from_word_counts(word_counts: dict) -> dict:
     """
     Maps AssemblyAI speaker labels (A, B, C...) to clinical role names.
     Assignment is based on word count — the speaker with the most words
@@ -14,15 +22,6 @@ def assign_speaker_roles(utterances: list, speakers_expected: int) -> dict:
 
     Returns a dict like: {'A': 'Doctor', 'B': 'Paciente', 'C': 'Familiar'}
     """
-    if not utterances:
-        return {}
-
-    word_counts = {}
-    for utt in utterances:
-        speaker = utt.get('speaker', 'A')
-        words = len(utt.get('text', '').split())
-        word_counts[speaker] = word_counts.get(speaker, 0) + words
-
     ranked = sorted(word_counts.keys(), key=lambda s: word_counts[s], reverse=True)
 
     role_names = ['Doctor', 'Paciente', 'Familiar', 'Enfermera']
@@ -36,51 +35,105 @@ def assign_speaker_roles(utterances: list, speakers_expected: int) -> dict:
 
     return role_map
 
+
+# Header AssemblyAI sends back on webhook calls, carrying Config.ASSEMBLYAI_WEBHOOK_SECRET
+WEBHOOK_AUTH_HEADER = 'X-ClinIA-Webhook-Secret'
+
+# Bump when the TranscriptionConfig below changes (model, spelling, flags)
+TRANSCRIPTION_CONFIG_VERSION = 'v1'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Content-addressed transcript cache — None unless TRANSCRIPT_CACHE_DIR is set
+transcript_cache = (
+    ExtractionCache(Config.TRANSCRIPT_CACHE_DIR, Config.TRANSCRIPT_CACHE_TTL_SECONDS)
+    if Config.TRANSCRIPT_CACHE_DIR else None
+)
+
+
+def audio_cache_key(audio_source: Union[str, BinaryIO], speakers_expected: int = 0,
+                    speaker_labels: bool = False) -> Optional[str]:
+    """
+    Transcript cache key: SHA-256 of the audio content (read in 1 MB chunks) plus
+    everything that changes the transcript. File objects are rewound afterwards.
+    None for URLs, whose content is not available locally.
+    """
+    digest = hashlib.sha256()
+    if isinstance(audio_source, str):
+        if audio_source.startswith(('http://', 'https://')):
+            return None
+        with open(audio_source, 'rb') as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+    elif isinstance(audio_source, io.BytesIO):
+        # Hash the buffer in place — no chunk copies
+        with audio_source.getbuffer() as view:
+            digest.update(view[audio_source.tell():])
+    else:
+        start = audio_source.tell()
+        while chunk := audio_source.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+        audio_source.seek(start)
+    speakers = f"spk{speakers_expected}" if speaker_labels else "nospk"
+    variant = f"{TRANSCRIPTION_CONFIG_VERSION}:{Config.PRIMARY_LANGUAGE}:{speakers}"
+    return make_key('assemblyai', 'medical-v1', variant, digest.hexdigest())
+
+
 class TranscriptionService:
     """Handles audio transcription using AssemblyAI"""
 
-    def __init__(self):
-        """Initialize AssemblyAI with API key"""
+    @staticmethod
+    def _configure_sdk():
+        """Set the AssemblyAI API key — done on first use, not at import."""
         aai.settings.api_key = Config.ASSEMBLYAI_API_KEY
-        self.transcriber = aai.Transcriber()
 
-    def transcribe_audio(self, audio_file_path: str, print_raw: bool = True, speakers_expected: int = 0) -> Dict:
+    @functools.cached_property
+    def transcriber(self) -> aai.Transcriber:
+        """AssemblyAI transcriber, built on first use."""
+        self._configure_sdk()
+        return aai.Transcriber()
+
+    def transcribe_audio(self, audio_source: Union[str, BinaryIO], print_raw: bool = True, speakers_expected: int = 0,
+                         speaker_labels: bool = False) -> Dict:
         """
         Transcribe audio file using AssemblyAI
 
         Args:
-            audio_file_path: Path to audio file or URL
+            audio_source: Path to audio file, URL, or a binary file-like object.
+                File objects are streamed to AssemblyAI's upload endpoint in
+                64 KB reads — the audio is never loaded into memory whole.
             print_raw: Whether to print raw transcript (for Alpha verification)
             speakers_expected: Hint to AssemblyAI for number of speakers (0 = not set)
+            speaker_labels: Run diarization (speaker-labeled utterances). Off by default —
+                it adds a second model pass, roughly doubling transcription latency
 
         Returns:
-            Dictionary containing transcript and metadata
+            Dictionary containing transcript and metadata; with the transcript cache on,
+            also its 'audio_cache_key' (see forget_transcript)
         """
-        logger.info(f"AssemblyAI: Starting transcription for: {audio_file_path}")
+        source_name = audio_source if isinstance(audio_source, str) else (getattr(audio_source, 'name', None) or '<stream>')
 
-        # Configure transcription settings for Spanish medical context
-        config = aai.TranscriptionConfig(
-            language_code="es",  # Spanish
-            punctuate=True,
-            format_text=True,
-            speaker_labels=True,  # Identify doctor vs patient (helpful for SOAP)
-            domain="medical-v1",  # Medical Mode: improved accuracy for medications, dosages, diagnoses
-            **({'speakers_expected': speakers_expected} if speakers_expected > 0 else {})
-        )
+        cache_key = audio_cache_key(audio_source, speakers_expected, speaker_labels) if transcript_cache else None
+        if cache_key:
+            cached = transcript_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"AssemblyAI: Served from transcript cache: {source_name}")
+                cached['audio_cache_key'] = cache_key
+                if print_raw:
+                    self._log_raw(cached)
+                return cached
 
-        # Configure custom spelling
-        config.set_custom_spelling(
-          {
-            "esguince": ["esquinza"],
-          }
-        )
+        logger.info(f"AssemblyAI: Starting transcription for: {source_name}")
+
+        config = self._transcription_config(speakers_expected, speaker_labels)
 
         try:
-            # Submit transcription
-            transcript = self.transcriber.transcribe(
-                audio_file_path,
-                config=config
-            )
+            # Submit transcription — local files are handed over as an open
+            # handle; the SDK streams it to /v2/upload in 64 KB chunks
+            if isinstance(audio_source, str) and not audio_source.startswith(('http://', 'https://')):
+                with open(audio_source, 'rb') as audio_file:
+                    transcript = self.transcriber.transcribe(audio_file, config=config)
+            else:
+                transcript = self.transcriber.transcribe(audio_source, config=config)
 
             logger.info("AssemblyAI: Transcription submitted, waiting for completion...")
 
@@ -88,59 +141,12 @@ class TranscriptionService:
             if transcript.status == aai.TranscriptStatus.error:
                 raise Exception(f"Transcription failed: {transcript.error}")
 
-            # Prepare result
-            result = {
-                "text": transcript.text,
-                "confidence": transcript.confidence,
-                "audio_duration": transcript.audio_duration,
-                "words": len(transcript.words) if transcript.words else 0,
-                "utterances": [],
-                "transcript_id": transcript.id
-            }
-
-            # Add speaker-separated utterances if available
-            if transcript.utterances:
-                result["utterances"] = [
-                    {
-                        "speaker": utt.speaker,
-                        "text": utt.text,
-                        "confidence": utt.confidence,
-                        "start": utt.start,
-                        "end": utt.end
-                    }
-                    for utt in transcript.utterances
-                ]
-
-            # Assign clinical role names to speaker labels
-            role_map = assign_speaker_roles(result["utterances"], speakers_expected)
-            result["speaker_role_map"] = role_map
-            logger.info(f"Transcription: Speaker role mapping: {role_map}")
-
-            # Verification: log raw transcript details
-            if print_raw:
-                logger.debug(f"Transcription: Duration: {result['audio_duration'] / 1000:.2f} seconds")
-                logger.debug(f"Transcription: Confidence: {result['confidence']:.2%}")
-                logger.debug(f"Transcription: Word count: {result['words']}")
-                logger.debug(f"Transcription: Full text:\n{result['text']}")
-
-                if result["utterances"]:
-                    lines = []
-                    for utt in result["utterances"]:
-                        role = role_map.get(utt['speaker'], 'Hablante ' + utt['speaker'])
-                        lines.append(f"[{role}]: {utt['text']}")
-                    logger.debug("Transcription: Speaker-separated transcript:\n" + "\n".join(lines))
-
-            # LFPDPPP compliance: delete transcript from AssemblyAI servers immediately.
-            # Patient audio data must not be retained on third-party servers beyond
-            # what is strictly necessary for processing.
-            # Note: transcribe_from_bytes() calls this method, so deletion is
-            # covered for all callers — no separate handling needed there.
-            try:
-                aai.Transcript.delete_by_id(transcript.id)
-                logger.info(f"AssemblyAI: Transcript {transcript.id} deleted from servers.")
-            except Exception as del_err:
-                logger.warning(f"AssemblyAI: Could not delete transcript {transcript.id}: {str(del_err)}")
-                # Do NOT raise — deletion failure must never block the pipeline
+            result = self._build_result(transcript, print_raw)
+
+            if cache_key:
+                transcript_cache.put(cache_key, result, provider='assemblyai')
+                # Kept on the session so ARCO cancellation can evict the cached transcript
+                result['audio_cache_key'] = cache_key
 
             return result
 
@@ -148,32 +154,217 @@ class TranscriptionService:
             logger.error(f"AssemblyAI: Error during transcription: {str(e)}")
             raise
 
-    def transcribe_from_bytes(self, audio_data: bytes, print_raw: bool = True, speakers_expected: int = 0) -> Dict:
+    @staticmethod
+    def forget_transcript(cache_key: Optional[str]):
+        """Evict a cached transcript by its audio_cache_key — used on ARCO cancellation."""
+        if transcript_cache and cache_key:
+            transcript_cache.delete(cache_key)
+
+    def transcribe_many(self, sources: List[Union[str, BinaryIO, bytes]], print_raw: bool = False,
+                        speakers_expected: int = 0, speaker_labels: bool = False) -> List[Dict]:
+        """
+        Transcribe several recordings as one AssemblyAI group.
+
+        Local files, file objects and raw bytes are uploaded concurrently first;
+        the resulting URLs are then submitted with transcribe_group, which polls all
+        jobs together, so wall time is roughly one transcription instead of N.
+
+        Returns one entry per source, in input order: the same dict as
+        transcribe_audio, or {'error', 'details'} for a source that failed.
+        """
+        config = self._transcription_config(speakers_expected, speaker_labels)
+
+        def upload(source) -> tuple[Optional[str], Optional[Dict]]:
+            """(url, None) on success, (None, error entry) if this source could not be uploaded."""
+            try:
+                if isinstance(source, bytes):
+                    source = io.BytesIO(source)
+                if isinstance(source, str) and source.startswith(('http://', 'https://')):
+                    return source, None
+                return self.transcriber.upload_file(source), None
+            except Exception as e:
+                logger.warning(f"AssemblyAI: Upload failed: {e}")
+                return None, {'error': 'Upload failed', 'details': str(e)}
+
+        with ThreadPoolExecutor(max_workers=Config.TRANSCRIPTION_UPLOAD_WORKERS) as pool:
+            uploads = list(pool.map(upload, sources))
+        urls = [url for url, _ in uploads if url is not None]
+        logger.info(f"AssemblyAI: Uploaded {len(urls)}/{len(uploads)} files, transcribing as a group...")
+
+        by_url = {}
+        if urls:
+            group, failures = self.transcriber.transcribe_group(urls, config=config, return_failures=True)
+            for failure in failures:
+                logger.warning(f"AssemblyAI: Group submission failure: {failure}")
+            # The SDK collects the group in completion order — match results back by URL
+            by_url = {transcript.audio_url: transcript for transcript in group.transcripts}
+
+        built = {}
+        results = []
+        for url, upload_error in uploads:
+            if upload_error:
+                results.append(upload_error)
+                continue
+            if url not in built:
+                transcript = by_url.get(url)
+                if transcript is None:
+                    built[url] = {'error': 'Transcription failed', 'details': 'Not submitted'}
+                elif transcript.status == aai.TranscriptStatus.error:
+                    built[url] = {'error': 'Transcription failed', 'details': str(transcript.error)}
+                else:
+                    built[url] = self._build_result(transcript, print_raw)
+            results.append(built[url])
+        return results
+
+    def submit_audio(self, audio_source: Union[str, BinaryIO], webhook_url: str, speakers_expected: int = 0,
+                     speaker_labels: bool = False) -> str:
+        """
+        Submit audio without waiting for it: AssemblyAI POSTs {transcript_id, status}
+        to webhook_url when the job finishes (see fetch_result), so no thread sits
+        polling. Only the upload happens in this call.
+
+        Returns:
+            The AssemblyAI transcript ID
+        """
+        config = self._transcription_config(speakers_expected, speaker_labels)
+        config.set_webhook(webhook_url, WEBHOOK_AUTH_HEADER, Config.ASSEMBLYAI_WEBHOOK_SECRET)
+
+        if isinstance(audio_source, str) and not audio_source.startswith(('http://', 'https://')):
+            with open(audio_source, 'rb') as audio_file:
+                transcript = self.transcriber.submit(audio_file, config=config)
+        else:
+            transcript = self.transcriber.submit(audio_source, config=config)
+
+        if transcript.status == aai.TranscriptStatus.error:
+            raise Exception(f"Transcription failed: {transcript.error}")
+        logger.info(f"AssemblyAI: Submitted {transcript.id}, awaiting webhook")
+        return transcript.id
+
+    def fetch_result(self, transcript_id: str, print_raw: bool = False) -> Dict:
+        """
+        Result dict (as transcribe_audio) for a transcript the webhook reported finished.
+        The transcript is deleted from AssemblyAI afterwards, as on the polling path.
+        """
+        self._configure_sdk()
+        transcript = aai.Transcript.get_by_id(transcript_id)
+        if transcript.status == aai.TranscriptStatus.error:
+            raise Exception(f"Transcription failed: {transcript.error}")
+        return self._build_result(transcript, print_raw)
+
+    def _transcription_config(self, speakers_expected: int = 0, speaker_labels: bool = False) -> aai.TranscriptionConfig:
+        """Transcription settings for the Spanish medical context. speakers_expected only applies with speaker_labels."""
+        config = aai.TranscriptionConfig(
+            language_code="es",  # Spanish
+            punctuate=True,
+            format_text=True,
+            speaker_labels=speaker_labels,  # Identify doctor vs patient (helpful for SOAP)
+            domain="medical-v1",  # Medical Mode: improved accuracy for medications, dosages, diagnoses
+            **({'speakers_expected': speakers_expected} if speaker_labels and speakers_expected > 0 else {})
+        )
+
+        # Configure custom spelling
+        config.set_custom_spelling(
+          {
+            "esguince": ["esquinza"],
+          }
+        )
+        return config
+
+    @staticmethod
+    def _log_raw(result: Dict):
+        """Verification (print_raw): log raw transcript details, for fresh and cached results alike."""
+        # Skipped outright unless DEBUG is on, so the full-text and
+        # per-utterance strings are never built in production
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug("Transcription: Duration: %.2f seconds", (result['audio_duration'] or 0) / 1000)
+        logger.debug("Transcription: Confidence: %.2f%%", (result['confidence'] or 0) * 100)
+        logger.debug("Transcription: Word count: %d", result['words'])
+        logger.debug("Transcription: Full text:\n%s", result['text'])
+
+        if result["utterances"]:
+            lines = []
+            for utt in result["utterances"]:
+                role = result['speaker_role_map'].get(utt['speaker'], 'Hablante ' + utt['speaker'])
+                lines.append(f"[{role}]: {utt['text']}")
+            logger.debug("Transcription: Speaker-separated transcript:\n%s", "\n".join(lines))
+
+    def _build_result(self, transcript: aai.Transcript, print_raw: bool) -> Dict:
+        """Result dict for a completed transcript; the transcript is then deleted from AssemblyAI."""
+        # Prepare result — utterances and per-speaker word counts in a single pass
+        # (transcript.utterances is None when speaker_labels was off)
+        utterances = []
+        word_counts = {}
+        for utt in transcript.utterances or ():
+            utterances.append({
+                "speaker": utt.speaker,
+                "text": utt.text,
+                "confidence": utt.confidence,
+                "start": utt.start,
+                "end": utt.end
+            })
+            # The SDK already split each utterance into words
+            word_counts[utt.speaker] = word_counts.get(utt.speaker, 0) + len(utt.words or ())
+
+        result = {
+            "text": transcript.text,
+            "confidence": transcript.confidence,
+            "audio_duration": transcript.audio_duration,
+            "words": len(transcript.words or ()),
+            "utterances": utterances,
+            "transcript_id": transcript.id
+        }
+
+        # Assign clinical role names to speaker labels
+        role_map = roles_from_word_counts(word_counts)
+        result["speaker_role_map"] = role_map
+        logger.info("Transcription: Speaker role mapping: %s", role_map)
+
+        if print_raw:
+            self._log_raw(result)
+
+        # LFPDPPP compliance: delete transcript from AssemblyAI servers immediately.
+        # Patient audio data must not be retained on third-party servers beyond
+        # what is strictly necessary for processing.
+        # Note: every transcription path (single, bytes, group) builds its result
+        # here, so deletion is covered for all callers.
+        try:
+            aai.Transcript.delete_by_id(transcript.id)
+            logger.info(f"AssemblyAI: Transcript {transcript.id} deleted from servers.")
+        except Exception as del_err:
+            logger.warning(f"AssemblyAI: Could not delete transcript {transcript.id}: {str(del_err)}")
+            # Do NOT raise — deletion failure must never block the pipeline
+
+        return result
+
+    async def transcribe_audio_async(self, audio_source: Union[str, BinaryIO], print_raw: bool = True, speakers_expected: int = 0,
+                                     speaker_labels: bool = False) -> Dict:
+        """
+        Async wrapper around transcribe_audio.
+        The AssemblyAI SDK blocks while polling, so the call runs in a worker
+        thread and the event loop stays free for other requests.
+        """
+        return await asyncio.to_thread(
+            self.transcribe_audio, audio_source, print_raw, speakers_expected, speaker_labels
+        )
+
+    def transcribe_from_bytes(self, audio_data: bytes, print_raw: bool = True, speakers_expected: int = 0,
+                              speaker_labels: bool = False) -> Dict:
         """
         Transcribe audio from bytes (for real-time recording)
 
         Args:
             audio_data: Raw audio bytes
             print_raw: Whether to print raw transcript
+            speakers_expected: Hint to AssemblyAI for number of speakers (0 = not set)
+            speaker_labels: Run diarization (see transcribe_audio)
 
         Returns:
             Dictionary containing transcript and metadata
         """
-        # Save bytes to temporary file
-        import tempfile
-        import os
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-            tmp_file.write(audio_data)
-            tmp_path = tmp_file.name
-
-        try:
-            result = self.transcribe_audio(tmp_path, print_raw, speakers_expected)
-            return result
-        finally:
-            # Clean up temporary file
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+        # The SDK takes a file object, so the bytes are wrapped in memory and
+        # uploaded (and hashed for the transcript cache) without a temp file
+        return self.transcribe_audio(io.BytesIO(audio_data), print_raw, speakers_expected, speaker_labels)
 
     def estimate_cost(self, audio_duration_seconds: float) -> float:
         """
@@ -190,11 +381,26 @@ class TranscriptionService:
         return audio_duration_seconds * 0.00025
 
 
+# Shared instance — one AssemblyAI transcriber (and HTTP session) per process
+_transcription_service = None
+_transcription_service_lock = threading.Lock()
+
+
+def get_transcription_service() -> TranscriptionService:
+    """Return the shared TranscriptionService, creating it on first use."""
+    global _transcription_service
+    if _transcription_service is None:
+        with _transcription_service_lock:
+            if _transcription_service is None:
+                _transcription_service = TranscriptionService()
+    return _transcription_service
+
+
 # Example usage and testing
 if __name__ == "__main__":
     # Test the transcription service
     Config.validate()
-    service = TranscriptionService()
+    service = get_transcription_service()
 
     logger.info("TranscriptionService initialized successfully")
     logger.info("Ready to transcribe audio files")